@@ -58,6 +58,60 @@ Output: c4r as 4D array
 
 *********************************************************************************************
 
+###################
+#Function 5: AVpVs#
+###################
+
+Calculate Vp azimuthal anisotropy, Vs azimuthal anisotropy and maximum Vs splitting from 
+single-crystal elasticity tensor Cijs in the form of 1D array and density, by searching the 
+velocities over a (m+1)x(m+1)xm cartesian grid of [nx,ny,+-nz] phonon directions, or over 
+the directions dirs given by the user, e.g. a uniform grid restricted to the fundamental 
+region of the Laue class from CijDirs.DirGrid.
+The whole grid is solved in one CijtvelBatch call and the extrema are found with argmax/argmin.
+With refine=True the grid is only a coarse global scan: the nstart best grid directions of 
+Vpmax, Vpmin, Vsmax, Vsmin and DelVsmax are each refined with a local optimizer (L-BFGS) on the 
+unit sphere, using the analytic velocity gradients of CijtvelGrad. A coarse grid (m of 6-10, or 
+a few hundred directions from DirGrid) plus a few hundred solves then gives the extrema to 
+machine precision.
+
+Input: c1d as 1x21 1D array, density, grid number m, optional dirs as (M,3) array, 
+	   optional refine (default False) and nstart (default 3)
+Output: AVp: [AVp, Vpmax, VpmaxPol, Vpmin, VpminPol]
+		AVs: [AVs, Vsmax, VsmaxPhon, Vsmaxpol, Vsmin, VsminPhon, Vsminpol]
+		DVs: [DVs, Vs1, DelVsmaxPhon, DelVsmaxPol1, Vs2, DelVsmaxPhon, DelVsmaxPol2]
+
+*********************************************************************************************
+
+##########################
+#Function 6: UnivAnisoCov#
+##########################
+
+Universal anisotropy index AU with exact first-order errors from the full covariance of c1d 
+(see CijVRHCov), instead of assuming Kv, Kr, Gv, Gr independent as UnivAniso does. 
+Vectorized over stacks of tensors.
+
+Input: c1d as 1x21 or (N,21) array, cov as 21x21 or (N,21,21) array, density, density error
+Output: (N,2) array of [AU, AUerr]
+
+*********************************************************************************************
+
+##########################
+#Function 7: GroupVelGrid#
+##########################
+
+Group velocities, power-flow angles and enhancement factors (CijtVel.CijtvelGroup) over the 
+same directions as AVpVs: the m grid of CubeGrid, or the directions dirs, e.g. from 
+CijDirs.DirGrid. One batched Christoffel solve serves the phase and the group velocities. 
+By default only vg and psi are computed (close to the cost of the phase velocities); 
+enhance=True adds the enhancement factor A at about 2.3x the cost of CijtvelBatch.
+
+Input: c1d as 1x21 1D array, density, grid number m, optional dirs as (M,3) array, 
+	   optional enhance (default False)
+Output: dict of CijtvelGroup (vel, pol, vg, gv, psi, A with enhance) and n, the (M,3) 
+		directions
+
+*********************************************************************************************
+
 Redistribution and use in source and binary forms, with or without modification, are permitted 
 provided that the following conditions are met:
 
@@ -85,8 +139,9 @@ All rights reserved.
 
 """
 import numpy as np
-from CijKGvrh import CijVRH
-from CijtVel import Cijtvel
+from CijKGvrh import CijVRH, CijVRHJac, CovC1dDens
+from CijtVel import CijtvelBatch, CijtvelGrad, CijtvelGroup
+from scipy.optimize import minimize
 
 ########################################################
 ######################Function 1: ######################
@@ -117,120 +172,148 @@ def UnivAniso(c1d,c1derr,dens,denserr):
     return UnivAniso
 	
 	
-def AVpVs(c1d,dens,m):
-    
-	#m is the grid number in 1D. e.g. if n=30, then a total of 27000 sets of HKL will be calculated.
-	
-    # Assume no error for density and Cij
-    denserr = 0.0 
-    c1derr= np.zeros(21)
-    Evrh = CijVRH (c1d,c1derr,dens,denserr)
-	
-	#Evrh format: 2X9 array
-	#[dens,Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs]
-	#[denserr,Kvrherrb,Kvrherrb,Kvrherr,Gvrherrb,Gvrherrb,Gvrherr,Vperr,Vserr]
-	
-    Vpvrh = Evrh[0,7]
-    Vsvrh = Evrh[0,8]		
-	# Format a 20x20x20 cartitian gird in the 3D HKL space
-    vel = np.zeros((1,3))
-    pol = np.zeros((3,3))
-    pol1d = np.zeros((1,9))
-
-    for nx in range (0, m+1):
-        for ny in range (0, m+1):
-            for nz in range (1, m+1):
-				#For minerals with symmetry equal or higher than Orthorhombic: 
-				#there is no difference between the velocities along [nx,ny,nz],[nx,-ny,nz],[nx,ny,-nz] and [nx,-ny,-nz]
-				#For minerals with monoclinic symmetry:
-				#the velocities along [nx,ny,nz]=[nx,-ny,nz] not equal to [nx,ny,-nz] =[nx,-ny,-nz]
-				#Thus, for the monoclinic symmetry, we need to consider both case
-				#positive
-				npos = np.array([nx,ny,nz])/1.0/m 
-				veltpos, poltpos = Cijtvel(c1d, npos, dens)
-				pol1dtpos = np.reshape(poltpos,9)
-				vel = np.append(vel,[veltpos],axis=0)
-				pol1d = np.append(pol1d,[pol1dtpos],axis=0)  
-				#negative 
-				nneg = np.array([nx,ny,-nz])/1.0/m            
-				veltneg, poltneg = Cijtvel(c1d, nneg, dens)
-				pol1dtneg = np.reshape(poltneg,9)            
-				vel = np.append(vel,[veltneg],axis=0)
-				pol1d = np.append(pol1d,[pol1dtneg],axis=0) 
-				#print vel
-				#print pol1d
-    VelPol = np.transpose(np.concatenate((vel.T,pol1d.T),axis=0))
-    VelPol = np.delete(VelPol, (0), axis=0)
-	
-	
-	#######"Calculating Vp azimuthal anisotropy"#######
-
-    Vp = VelPol[:,0]
-    Vpmax = Vp.max() #the calculated velocities from cij follow the sequence Vp>Vs1>Vs2
-    Vpmin = Vp.min()
+def CubeGrid(m):
 
-    VpmaxIndex = np.where(Vp == Vpmax)[0]
-    VpmaxPol = np.array([VelPol[VpmaxIndex[0],3], VelPol[VpmaxIndex[0],4], VelPol[VpmaxIndex[0],5]])
+    # (m+1)x(m+1)xm cartesian grid of phonon directions [nx,ny,nz] and [nx,ny,-nz]
+    # For minerals with symmetry equal or higher than Orthorhombic: 
+    # there is no difference between the velocities along [nx,ny,nz],[nx,-ny,nz],[nx,ny,-nz] and [nx,-ny,-nz]
+    # For minerals with monoclinic symmetry:
+    # the velocities along [nx,ny,nz]=[nx,-ny,nz] not equal to [nx,ny,-nz] =[nx,-ny,-nz]
+    # Thus, for the monoclinic symmetry, we need to consider both case
+    nx, ny, nz = np.meshgrid(np.arange(m+1), np.arange(m+1), np.arange(1,m+1), indexing='ij')
+    npos = np.stack((nx,ny,nz), axis=-1).reshape(-1,3)
+    nneg = npos*np.array([1,1,-1])
+    return np.stack((npos,nneg), axis=1).reshape(-1,3)/1.0/m
 
-    VpminIndex = np.where(Vp == Vpmin)[0]
-    VpminPol = np.array([VelPol[VpminIndex[0],3], VelPol[VpminIndex[0],4], VelPol[VpminIndex[0],5]])
 
-	#print '\n', 'Max Vp azimuthal anisotropy is:'
-	#print 'Vpmax - Index numbers - Phonon/Polarization direction:', Vpmax, VpmaxIndex, VpmaxPol 
-	#print 'Vpmin - Index numbers - Phonon/Polarization direction:', Vpmin, VpminIndex, VpminPol
-    AVp = (Vpmax-Vpmin)/Vpvrh
-	#print 'Vpmax-Vpmin is',Vpmax-Vpmin 
-	#print 'Vp azimuthal anisotropy (Vpmax-Vpmin)/Vpvrh is', AVp
-    AVp =([AVp, Vpmax, VpmaxPol, Vpmin, VpminPol])
+def VelExtrema(vel,pol,Vpvrh,Vsvrh):
 
-	#######"Calculating Vs anisotropy"#######
+    # vel: (M,3) velocities in sequence of Vp>Vs1>Vs2; pol: (M,3,3) polarizations, pol[:,0] for Vp
 
-    Vs1 = VelPol[:,1]
-    Vs2 = VelPol[:,2]
+    #######"Calculating Vp azimuthal anisotropy"#######
 
-	###"1. azimuthal anisotropy"###
+    Vp = vel[:,0]
+    VpmaxIndex = np.argmax(Vp)
+    VpminIndex = np.argmin(Vp)
+    Vpmax = Vp[VpmaxIndex]
+    Vpmin = Vp[VpminIndex]
+    VpmaxPol = pol[VpmaxIndex,0]
+    VpminPol = pol[VpminIndex,0]
+    AVp = (Vpmax-Vpmin)/Vpvrh
+    AVp = ([AVp, Vpmax, VpmaxPol, Vpmin, VpminPol])
 
-    Vsmax = Vs1.max()
-    Vsmin = Vs2.min()
+    #######"Calculating Vs anisotropy"#######
 
-    VsmaxIndex = np.where(Vs1 == Vsmax)[0]
-    VsmaxPhon = np.array([VelPol[VsmaxIndex[0],3], VelPol[VsmaxIndex[0],4], VelPol[VsmaxIndex[0],5]])
-    VsmaxPol = np.array([VelPol[VsmaxIndex[0],6], VelPol[VsmaxIndex[0],7], VelPol[VsmaxIndex[0],8]])
+    Vs1 = vel[:,1]
+    Vs2 = vel[:,2]
 
-    VsminIndex = np.where(Vs2 == Vsmin)[0]
-    VsminPhon = np.array([VelPol[VsminIndex[0],3], VelPol[VsminIndex[0],4], VelPol[VsminIndex[0],5]])
-    VsminPol = np.array([VelPol[VsminIndex[0],9], VelPol[VsminIndex[0],10], VelPol[VsminIndex[0],11]])
+    ###"1. azimuthal anisotropy"###
 
-	#print '\n', 'Max Vs azimuthal anisotropy is:'
-	#print 'Vsmax - Index numbers - Phonon - Polarization direction:', '\n', Vsmax, VsmaxIndex, VsmaxPhon, VsmaxPol 
-	#print 'Vsmin - Index numbers - Phonon - Polarization direction:', '\n', Vsmin, VsminIndex, VsminPhon, VsminPol
+    VsmaxIndex = np.argmax(Vs1)
+    VsminIndex = np.argmin(Vs2)
+    Vsmax = Vs1[VsmaxIndex]
+    Vsmin = Vs2[VsminIndex]
+    VsmaxPhon = pol[VsmaxIndex,0]
+    VsmaxPol = pol[VsmaxIndex,1]
+    VsminPhon = pol[VsminIndex,0]
+    VsminPol = pol[VsminIndex,2]
     AVs = (Vsmax-Vsmin)/Vsvrh
-	#print 'Vsmax-Vsmin is',Vsmax-Vsmin 
-	#print 'Vs azimuthal anisotropy (Vsmax-Vsmin)/Vsvrh is', AVs
     AVs = ([AVs, Vsmax, VsmaxPhon, VsmaxPol, Vsmin, VsminPhon, VsminPol]) 
 
-	###"2.Vs splitting anisotropy"###
+    ###"2.Vs splitting anisotropy"###
 
     DelVs = Vs1-Vs2 #the calculated velocities from cij follow the sequence Vp>Vs1>Vs2
+    DelVsmaxIndex = np.argmax(DelVs)
+    DelVsmax = DelVs[DelVsmaxIndex]
+    DelVsmaxPhon = pol[DelVsmaxIndex,0]
+    DelVsmaxPol1 = pol[DelVsmaxIndex,1]
+    DelVsmaxPol2 = pol[DelVsmaxIndex,2]
+    DVs = DelVsmax/Vsvrh
+    DVs = ([DVs, Vs1[DelVsmaxIndex], DelVsmaxPhon, DelVsmaxPol1, Vs2[DelVsmaxIndex], DelVsmaxPhon, DelVsmaxPol2]) 
 
-    DelVsmax = DelVs.max()
+    return AVp, AVs, DVs
 
-    DelVsmaxIndex = np.where(DelVs == DelVsmax)[0]
-    DelVsmaxPhon = np.array([VelPol[DelVsmaxIndex[0],3], VelPol[DelVsmaxIndex[0],4], VelPol[DelVsmaxIndex[0],5]])
-    DelVsmaxPol1 = np.array([VelPol[DelVsmaxIndex[0],6], VelPol[DelVsmaxIndex[0],7], VelPol[DelVsmaxIndex[0],8]])
-    DelVsmaxPol2 = np.array([VelPol[DelVsmaxIndex[0],9], VelPol[DelVsmaxIndex[0],10], VelPol[DelVsmaxIndex[0],11]])
 
-	#print '\n', 'Max Vs splitting anisotropy is along phonon direction:', DelVsmaxPhon
-	#print 'Index numbers in the stored results are:', DelVsmaxIndex
-	#print 'Vs1 with polarization direction:', VelPol[DelVsmaxIndex[0],1], DelVsmaxPol1
-	#print 'Vs2 with polarization direction:',  VelPol[DelVsmaxIndex[0],2],DelVsmaxPol2
-    DVs = DelVsmax/Vsvrh
-	#print 'Delta_Vsmax is',DelVsmax
-	#print 'Vs splitting anisotropy (Delta_Vsmax)/Vsvrh is', DVs
-    DVs = ([DVs, VelPol[DelVsmaxIndex[0],1], DelVsmaxPhon, DelVsmaxPol1, VelPol[DelVsmaxIndex[0],2], DelVsmaxPhon, DelVsmaxPol2]) 
-	# AVpVs[0]: 1x5 array [AVp, Vpmax, VpmaxPol, Vpmin, VpminPol]
-	# AVpVs[1]: 1x7 array [AVs, Vsmax, VsmaxPhon, Vsmaxpol, Vsmin, VsminPhon, Vsminpol]
-	# AVpVs[2]: 1x7 array [DVs, VelPol[DelVsmaxIndex[0],1], DelVsmaxPhon, DelVsmaxPol1, VelPol[DelVsmaxIndex[0],2], DelVsmaxPhon, DelVsmaxPol2]
-	
-	
-    return AVp, AVs, DVs
\ No newline at end of file
+def RefineVel(c1d,dens,n0,mode,sign):
+
+    # Local search of one velocity extremum starting from direction n0
+    # mode: 0 Vp, 1 Vs1, 2 Vs2, 3 Vs1-Vs2; sign: 1 for maximum, -1 for minimum
+    def fun(x):
+        vel, pol, grad = CijtvelGrad(c1d, x, dens)
+        if mode == 3:
+            f = vel[0,1]-vel[0,2]
+            g = grad[0,1]-grad[0,2]
+        else:
+            f = vel[0,mode]
+            g = grad[0,mode]
+        # gradient of V(x/|x|): tangential part of dV/dn scaled by 1/|x|
+        xn = np.linalg.norm(x)
+        n = x/xn
+        g = (g-np.dot(g,n)*n)/xn
+        return -sign*f, -sign*g
+    res = minimize(fun, n0/np.linalg.norm(n0), jac=True, method='L-BFGS-B', options={'gtol':1e-12, 'ftol':1e-15})
+    return res.x/np.linalg.norm(res.x)
+
+
+def AVpVs(c1d,dens,m,dirs=None,refine=False,nstart=3):
+    
+    #m is the grid number in 1D. e.g. if n=30, then a total of 27000 sets of HKL will be calculated.
+    #dirs: optional (M,3) phonon directions, e.g. CijDirs.DirGrid(1000,'cubic'), used instead of the m grid
+    
+    # Assume no error for density and Cij
+    denserr = 0.0 
+    c1derr= np.zeros(21)
+    Evrh = CijVRH (c1d,c1derr,dens,denserr)
+    
+    #Evrh format: 2X9 array
+    #[dens,Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs]
+    #[denserr,Kvrherrb,Kvrherrb,Kvrherr,Gvrherrb,Gvrherrb,Gvrherr,Vperr,Vserr]
+    
+    Vpvrh = Evrh[0,7]
+    Vsvrh = Evrh[0,8]
+
+    # Solve the whole grid at once
+    if dirs is None:
+        dirs = CubeGrid(m)
+    vel, pol = CijtvelBatch(c1d, dirs, dens)
+
+    if refine:
+        # Refine the best grid directions of each extremum; refined directions that beat the 
+        # grid are appended to it so VelExtrema picks them up
+        dirs = np.asarray(dirs, dtype=float)
+        targets = ((vel[:,0],0,1), (vel[:,0],0,-1), (vel[:,1],1,1), (vel[:,2],2,-1), (vel[:,1]-vel[:,2],3,1))
+        nref = []
+        for v, mode, sign in targets:
+            for i in np.argsort(-sign*v)[:nstart]:
+                nref.append(RefineVel(c1d, dens, dirs[i], mode, sign))
+        velref, polref = CijtvelBatch(c1d, np.array(nref), dens)
+        vel = np.concatenate((vel, velref))
+        pol = np.concatenate((pol, polref))
+
+    # AVpVs[0]: 1x5 array [AVp, Vpmax, VpmaxPol, Vpmin, VpminPol]
+    # AVpVs[1]: 1x7 array [AVs, Vsmax, VsmaxPhon, Vsmaxpol, Vsmin, VsminPhon, Vsminpol]
+    # AVpVs[2]: 1x7 array [DVs, Vs1 at DelVsmax, DelVsmaxPhon, DelVsmaxPol1, Vs2 at DelVsmax, DelVsmaxPhon, DelVsmaxPol2]
+    return VelExtrema(vel, pol, Vpvrh, Vsvrh)
+
+
+def UnivAnisoCov(c1d,cov,dens,denserr):
+    
+    vals, jac = CijVRHJac(c1d, dens)
+    Kv, Kr, Gv, Gr = vals[:,0], vals[:,1], vals[:,3], vals[:,4]
+    AU = 5.0*Gv/Gr+Kv/Kr-6.0
+    dAU = (5.0*(jac[:,3]/Gr[:,None]-(Gv/Gr**2)[:,None]*jac[:,4])
+           +jac[:,0]/Kr[:,None]-(Kv/Kr**2)[:,None]*jac[:,1])
+    covf = CovC1dDens(cov, denserr, len(vals))
+    AUerr = np.einsum('ni,nij,nj->n', dAU, covf, dAU)**0.5
+    return np.stack((AU, AUerr), axis=1)
+
+
+def GroupVelGrid(c1d,dens,m,dirs=None,enhance=False):
+
+    if dirs is None:
+        dirs = CubeGrid(m)
+    dirs = np.asarray(dirs, dtype=float)
+    res = CijtvelGroup(c1d, dirs, dens, enhance)
+    res['n'] = dirs
+    return res
+
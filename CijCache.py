@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in, content-addressed memoization of velocity and anisotropy results
+
+*********************************************************************************************
+
+#####################
+#Function 1: CijKey #
+#####################
+
+Hash key of a function call: the function name and the content (dtype, shape and bytes) of 
+every argument after binding to the signature with defaults, e.g. c1d, density, the direction 
+set and the grid settings. An ElasticTensor is hashed by its c1d. Two calls with identical 
+tensors and settings give the same key.
+
+Input: function, positional and keyword arguments
+Output: key as hex string
+
+*********************************************************************************************
+
+######################
+#Function 2: CijCache#
+######################
+
+Two-tier cache of function results:
+	memory  LRU dictionary with a byte budget (maxbytes); the least recently used results are 
+	        evicted once the budget is exceeded
+	disk    optional directory cachedir with one .npz file per key, so a rerun of a long 
+	        anisotropy survey for an unchanged tensor returns instantly
+Results (arrays, scalars and nested lists/tuples of them, as returned by Cijtvel, CijtvelBatch, 
+CijVRH, UnivAniso and AVpVs) are stored with read-only arrays.
+Counters hits, diskhits, misses, evictions and the memory size nbytes are kept for sizing the 
+cache, stats() returns them as a dict.
+
+Usage:
+	cache = CijCache(maxbytes=512*2**20, cachedir='cache')
+	AVp, AVs, DVs = cache.call(AVpVs, c1d, dens, 30)
+	or the shortcuts cache.Cijtvel, cache.CijtvelBatch, cache.CijVRH, cache.UnivAniso, cache.AVpVs
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import os
+import json
+import hashlib
+import inspect
+from collections import OrderedDict
+import numpy as np
+from CijtVel import Cijtvel, CijtvelBatch
+from CijKGvrh import CijVRH
+from CijAniso import UnivAniso, AVpVs
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+def HashArg(h,x):
+
+    if x is None or isinstance(x, (str, bool)):
+        h.update(repr(x).encode())
+        return
+    x = np.asarray(x)
+    if x.dtype.kind in 'biuf':
+        x = np.ascontiguousarray(x, dtype=float)
+    h.update(('%s%s' % (x.dtype.str, x.shape)).encode())
+    h.update(x.tobytes() if x.dtype.kind != 'O' else repr(x.tolist()).encode())
+
+
+def CijKey(fn,args,kws):
+
+    # bind to the signature so positional, keyword and default arguments give the same key
+    ba = inspect.signature(fn).bind(*args, **kws)
+    ba.apply_defaults()
+    h = hashlib.blake2b(digest_size=20)
+    h.update(('%s.%s' % (fn.__module__, fn.__name__)).encode())
+    for k, x in ba.arguments.items():
+        h.update(k.encode())
+        HashArg(h, x)
+    return h.hexdigest()
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+def Pack(obj,leaves):
+
+    # nested lists/tuples of arrays and scalars -> json-able structure, arrays collected in leaves
+    if isinstance(obj, (list, tuple)):
+        return {'t': type(obj).__name__, 'v': [Pack(x, leaves) for x in obj]}
+    leaves.append(np.asarray(obj))
+    return {'t': 'a' if isinstance(obj, np.ndarray) else 's', 'v': len(leaves)-1}
+
+
+def Unpack(spec,leaves):
+
+    if spec['t'] in ('list', 'tuple'):
+        v = [Unpack(x, leaves) for x in spec['v']]
+        return tuple(v) if spec['t'] == 'tuple' else v
+    x = leaves[spec['v']]
+    if spec['t'] == 's':
+        return x[()]
+    x.setflags(write=False)
+    return x
+
+
+class CijCache(object):
+
+    def __init__(self,maxbytes=256*2**20,cachedir=None):
+        self.maxbytes = maxbytes
+        self.cachedir = cachedir
+        if cachedir is not None and not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.mem = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.diskhits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return dict(hits=self.hits, diskhits=self.diskhits, misses=self.misses,
+                    evictions=self.evictions, nbytes=self.nbytes, entries=len(self.mem))
+
+    def clear(self):
+        self.mem.clear()
+        self.nbytes = 0
+
+    def store(self,key,spec,leaves):
+        size = sum(x.nbytes for x in leaves)
+        if size > self.maxbytes:
+            return
+        self.mem[key] = (spec, leaves, size)
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            k, (s, l, sz) = self.mem.popitem(last=False)
+            self.nbytes -= sz
+            self.evictions += 1
+
+    def call(self,fn,*args,**kws):
+        key = CijKey(fn, args, kws)
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            self.hits += 1
+            spec, leaves, size = self.mem[key]
+            return Unpack(spec, leaves)
+        fname = None if self.cachedir is None else os.path.join(self.cachedir, key+'.npz')
+        if fname is not None and os.path.exists(fname):
+            with np.load(fname) as f:
+                spec = json.loads(str(f['spec']))
+                leaves = [f['arr_%d' % i] for i in range(len(f.files)-1)]
+            self.diskhits += 1
+            self.store(key, spec, leaves)
+            return Unpack(spec, leaves)
+        self.misses += 1
+        leaves = []
+        spec = Pack(fn(*args, **kws), leaves)
+        leaves = [np.array(x) for x in leaves]
+        if fname is not None:
+            tmp = fname[:-4]+'.%d.tmp.npz' % os.getpid()
+            np.savez(tmp, *leaves, spec=json.dumps(spec))
+            os.replace(tmp, fname)
+        self.store(key, spec, leaves)
+        return Unpack(spec, leaves)
+
+    def Cijtvel(self,c1d,n,dens):
+        return self.call(Cijtvel, c1d, n, dens)
+
+    def CijtvelBatch(self,c1d,n,dens):
+        return self.call(CijtvelBatch, c1d, n, dens)
+
+    def CijVRH(self,c1d,c1derr,dens,denserr):
+        return self.call(CijVRH, c1d, c1derr, dens, denserr)
+
+    def UnivAniso(self,c1d,c1derr,dens,denserr):
+        return self.call(UnivAniso, c1d, c1derr, dens, denserr)
+
+    def AVpVs(self,c1d,dens,m,dirs=None,refine=False,nstart=3):
+        return self.call(AVpVs, c1d, dens, m, dirs=dirs, refine=refine, nstart=nstart)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Phonon direction sampling for velocity and anisotropy searches
+
+*********************************************************************************************
+
+#######################
+#Function 1: FibSphere#
+#######################
+
+Nearly uniform directions on the unit sphere from the Fibonacci (golden spiral) lattice. 
+start and stop give the slice [start:stop] of the lattice without building the rest, for 
+streaming very dense grids in chunks (CijSurf).
+
+Input: number of directions npts, optional start, stop
+Output: n as (npts,3) array of unit vectors, (stop-start,3) for a slice
+
+*********************************************************************************************
+
+###########################
+#Function 2: HealpixSphere#
+###########################
+
+Centres of the HEALPix equal-area pixels (ring scheme) on the unit sphere
+
+Input: HEALPix resolution nside, giving 12*nside**2 directions
+Output: n as (12*nside**2,3) array of unit vectors
+
+*********************************************************************************************
+
+########################
+#Function 3: FundRegion#
+########################
+
+Mask of the directions inside the fundamental region of the Laue class of a crystal system. 
+Velocities are centrosymmetric (v(n) = v(-n)), so the Laue class, not the point group, sets 
+which directions are equivalent. The regions follow the c1d convention of CijSij124d 
+(monoclinic 2-fold axis along x2):
+	triclinic     (-1):    z >= 0
+	monoclinic    (2/m):   y >= 0, z >= 0
+	orthorhombic  (mmm):   x >= 0, y >= 0, z >= 0
+	tetragonal    (4/mmm): x >= y >= 0, z >= 0
+	hexagonal     (6/mmm): x >= 3**0.5*y >= 0, z >= 0
+	cubic         (m-3m):  z >= x >= y >= 0
+
+Input: n as (M,3) array, symmetry as one of the names above
+Output: (M,) boolean array
+
+*********************************************************************************************
+
+#####################
+#Function 4: DirGrid#
+#####################
+
+Uniform directions restricted to the fundamental region of the Laue class. The sphere is 
+sampled with npts times the Laue class multiplicity so that about npts directions fall 
+inside the region, then the region edges (the mirror planes, where extrema usually sit) 
+are sampled at the same spacing and the high-symmetry axes are added explicitly.
+The result can be passed to AVpVs as dirs, e.g. AVpVs(c1d, dens, None, dirs=DirGrid(1000,'cubic')).
+
+Input: npts, symmetry (default triclinic), method as 'fibonacci' or 'healpix'
+Output: n as (M,3) array of unit vectors
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import numpy as np
+
+# Number of equivalent directions on the full sphere for each Laue class
+LaueOrder = {'triclinic':2, 'monoclinic':4, 'orthorhombic':8, 'tetragonal':16, 'hexagonal':24, 'cubic':48}
+
+s3 = 3.0**0.5
+# Edges of the fundamental regions as great-circle arcs between two unit vectors (each < 180 deg)
+LaueEdges = {
+    'triclinic':    [([1,0,0],[0,1,0]), ([0,1,0],[-1,0,0]), ([-1,0,0],[0,-1,0]), ([0,-1,0],[1,0,0])],
+    'monoclinic':   [([1,0,0],[0,1,0]), ([0,1,0],[-1,0,0]), ([1,0,0],[0,0,1]), ([0,0,1],[-1,0,0])],
+    'orthorhombic': [([1,0,0],[0,1,0]), ([0,1,0],[0,0,1]), ([0,0,1],[1,0,0])],
+    'tetragonal':   [([1,0,0],[1,1,0]), ([1,1,0],[0,0,1]), ([0,0,1],[1,0,0])],
+    'hexagonal':    [([1,0,0],[s3,1,0]), ([s3,1,0],[0,0,1]), ([0,0,1],[1,0,0])],
+    'cubic':        [([0,0,1],[1,0,1]), ([1,0,1],[1,1,1]), ([1,1,1],[0,0,1])],
+}
+
+# High-symmetry axes, kept only where they fall inside the region
+SymAxes = np.array([[1,0,0],[0,1,0],[0,0,1],[1,1,0],[1,0,1],[0,1,1],[1,1,1],[s3,1,0]])
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+def FibSphere(npts,start=0,stop=None):
+
+    i = np.arange(start, npts if stop is None else min(stop, npts))+0.5
+    z = 1.0-2.0*i/npts
+    r = (1.0-z**2)**0.5
+    phi = np.pi*(3.0-5.0**0.5)*i
+    return np.stack((r*np.cos(phi), r*np.sin(phi), z), axis=1)
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+def HealpixSphere(nside):
+
+    # polar caps: rings 1..nside-1 with 4*i pixels each
+    i = np.arange(1,nside)
+    ic = np.repeat(i, 4*i)
+    jc = np.concatenate([np.arange(1,4*k+1) for k in i]) if nside > 1 else np.zeros(0)
+    zc = 1.0-ic**2/(3.0*nside**2)
+    phic = np.pi/(2.0*ic)*(jc-0.5)
+    # equatorial belt: rings nside..3*nside with 4*nside pixels each
+    ie = np.repeat(np.arange(nside,3*nside+1), 4*nside)
+    je = np.tile(np.arange(1,4*nside+1), 2*nside+1)
+    ze = 4.0/3.0-2.0*ie/(3.0*nside)
+    phie = np.pi/(2.0*nside)*(je-((ie-nside+1)%2)/2.0)
+    z = np.concatenate((zc, ze, -zc))
+    phi = np.concatenate((phic, phie, phic))
+    r = (1.0-z**2)**0.5
+    return np.stack((r*np.cos(phi), r*np.sin(phi), z), axis=1)
+
+########################################################
+######################Function 3: ######################
+########################################################
+
+def FundRegion(n,symmetry):
+
+    x, y, z = np.asarray(n, dtype=float).T
+    tol = 1e-9
+    if symmetry == 'triclinic':
+        return z >= -tol
+    if symmetry == 'monoclinic':
+        return (y >= -tol) & (z >= -tol)
+    if symmetry == 'orthorhombic':
+        return (x >= -tol) & (y >= -tol) & (z >= -tol)
+    if symmetry == 'tetragonal':
+        return (x >= y-tol) & (y >= -tol) & (z >= -tol)
+    if symmetry == 'hexagonal':
+        return (x >= s3*y-tol) & (y >= -tol) & (z >= -tol)
+    if symmetry == 'cubic':
+        return (z >= x-tol) & (x >= y-tol) & (y >= -tol)
+    raise ValueError('unknown symmetry %s, use one of %s' % (symmetry, ', '.join(LaueOrder)))
+
+########################################################
+######################Function 4: ######################
+########################################################
+
+def DirGrid(npts,symmetry='triclinic',method='fibonacci'):
+
+    ntot = int(npts*LaueOrder[symmetry])
+    if method == 'fibonacci':
+        n = FibSphere(ntot)
+    elif method == 'healpix':
+        n = HealpixSphere(max(1, int(round((ntot/12.0)**0.5))))
+    else:
+        raise ValueError('unknown method %s, use fibonacci or healpix' % method)
+    n = n[FundRegion(n, symmetry)]
+    # sample the region edges with the same angular spacing as the interior
+    step = (4.0*np.pi/ntot)**0.5
+    edges = []
+    for a, b in LaueEdges[symmetry]:
+        a = np.array(a, dtype=float)/np.linalg.norm(a)
+        b = np.array(b, dtype=float)/np.linalg.norm(b)
+        ang = np.arccos(np.clip(np.dot(a,b), -1.0, 1.0))
+        t = np.linspace(0.0, 1.0, max(2, int(np.ceil(ang/step))+1))[:,None]
+        edges.append((np.sin((1.0-t)*ang)*a+np.sin(t*ang)*b)/np.sin(ang))
+    axes = SymAxes/np.linalg.norm(SymAxes, axis=1)[:,None]
+    n = np.concatenate([n]+edges+[axes[FundRegion(axes, symmetry)]])
+    return np.unique(np.round(n, 12), axis=0)
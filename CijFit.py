@@ -0,0 +1,832 @@
+# -*- coding: utf-8 -*-
+"""
+Least-squares fitting of single-crystal Cij to measured sound velocities (Brillouin or 
+ultrasonic), replacing the per-sample fitting notebook
+
+*********************************************************************************************
+
+################################
+#Function 1: Symmetry classes  #
+################################
+
+Cubic, Hexagonal, Tetragonal, Orthorhombic, Monoclinic and Triclinic map the free elastic 
+constants of each crystal system into the 21-element c1d vector used by Cijtvel:
+	Cubic:        C11, C44, C12                      (3 constants)
+	Hexagonal:    C11, C33, C44, C12, C13            (5 constants, C66 = (C11-C12)/2)
+	Tetragonal:   C11, C33, C44, C66, C12, C13       (6 constants)
+	Orthorhombic: C11 ... C23                        (9 constants)
+	Monoclinic:   C11 ... C23, C15, C25, C35, C46    (13 constants, 2-fold axis along x2)
+	Triclinic:    all 21 constants in the c1d sequence
+The map is linear, c1d = Map.dot(p), so Map is also the Jacobian dc1d/dp.
+Sym('cubic') returns the class instance from its name.
+
+*********************************************************************************************
+
+#####################
+#Function 2: LoadVel#
+#####################
+
+Read a velocity dataset such as cubic/input/0.dat in a single pass (CijLoad.ReadVel, with its 
+.npz sidecar cache). Columns: nx ny nz Vp Vs1 Vs2, velocities in m/s, 0 for a velocity that 
+was not measured. Use ReadVel directly for the mask, uncertainties and metadata.
+
+Input: file name
+Output: n as (M,3) array of phonon directions, vobs as (M,3) array of velocities in km/s
+
+*********************************************************************************************
+
+#####################
+#Function 3: ResVel #
+#####################
+
+Vectorized residual and analytic Jacobian of the velocity fit. The calculated Vp is compared 
+to the measured Vp; each measured shear velocity is compared to the closer of the calculated 
+Vs1 and Vs2 (vectorized min-distance matching, ShearMode).
+Missing velocities (0) are encoded once by VelMask as the flat indices idx of the measured 
+velocities, together with their weights w = 1/sigma. sigma is the uncertainty of each 
+observation (scalar or (M,3) array, replaces the epsVp/epsVs1/epsVs2 arrays of the notebook). 
+The residual then has a fixed length and needs no list building per call.
+The fits use VelData.res and VelData.jac (Function 5); ResVel and JacVel are one-off 
+wrappers that build the VelData of their arguments.
+
+Input: c1d, n as (M,3), vobs as (M,3), density, optional sigma
+Output: weighted residual (calculated - measured)/sigma as 1D array; JacVel returns its 
+		derivatives with respect to c1d
+
+*********************************************************************************************
+
+####################
+#Function 4: CijFit#
+####################
+
+Fit the free constants of a symmetry class to a velocity dataset with lmfit leastsq and the 
+analytic Jacobian.
+
+Input: n, vobs, density, sym (class instance or name), starting values p0 (dict or array in 
+	   the order of sym.names, or lmfit Parameters with exactly the constants of sym.names in 
+	   any order, fixed or varied but not tied by expr), optional pmin, pmax (dict or array), 
+	   sigma (uncertainty of each velocity, scalar or (M,3) array) and lmfit keywords
+Output: FitResult with
+	names, values, errors    fitted constants and 1-sigma errors
+	c1d, c1derr              the same mapped into the 21-element c1d
+	c1dcov                   21x21 covariance of c1d
+	covar                    covariance matrix of the varied constants
+	chisqr, redchi, nfev     fit statistics
+	time                     wall time of the fit in seconds
+	result, minimizer        the lmfit MinimizerResult and Minimizer, e.g. for conf_interval
+	data                     the VelData that was fitted, e.g. for CijCI
+
+*********************************************************************************************
+
+#####################
+#Function 5: VelData#
+#####################
+
+Prepared velocity dataset. Everything that does not change during a fit is computed once: the 
+normalized directions, the missing-data mask and weights (VelMask) and the (M,3,3,21) 
+Christoffel basis (ChristoffelBasis), so the forward model of each iteration is one tensor 
+contraction plus a batched eigen-solve, and the Jacobian comes from the same eigenvectors:
+	A = basis.dot(c1d),  dE/dc1d[q] = p.basis[...,q].p,  dV/dc1d = dE/dc1d/(2*dens*V)
+CijFit builds a VelData from its arrays; CijFitData fits a VelData directly.
+
+Input: n as (M,3), vobs as (M,3), density, optional sigma
+Methods: vel(c1d) -> vel, pol as CijtvelBatch (the last solve is kept, so res and jac at the 
+		 same c1d share one eigen-solve); res(c1d) residual; jac(c1d) dres/dc1d; 
+		 take(rows) the dataset of the directions rows (repeats allowed), sharing the 
+		 prepared basis instead of rebuilding it, e.g. for CijResample
+
+*********************************************************************************************
+
+##########################
+#Function 6: CijFitBatch #
+##########################
+
+Fit a directory of datasets (one input/*.dat per pressure or temperature point) across a 
+process pool. FitFiles finds the files and orders them along the P/T axis, read from the 
+numeric file name (0.dat, 1.5.dat, ...) unless axis values are given. CijFitIter yields 
+one row per dataset as soon as its fit is done (the workers send each row back through a 
+queue, also in the middle of a chained segment); CijFitBatch collects the rows and streams 
+them into one text table (out), one line per finished fit.
+With chain=True the ordered series is cut into nchain contiguous segments (default: one per 
+process). Within a segment the fits run in order and each one starts from the solution of 
+its neighbour, so only the first point of a segment uses p0.
+
+Input: files (list of file names or a directory), density (scalar, one per file, or None to 
+	   take it from the metadata of each file, see CijLoad), sym, p0, 
+	   optional pmin, pmax, sigma, axis (P/T value of each file), chain, nchain, processes 
+	   (default: all cores, 1 runs in this process), out (table file name), lmfit keywords
+Output: structured array sorted along the axis with fields file, axis, dens, the fitted 
+		constants and their errors (<name>err), chisqr, redchi, nfev, time, success
+
+*********************************************************************************************
+
+##########################
+#Function 7: CijFitMulti  #
+##########################
+
+Multi-start global search for fits with many local minima (low symmetry, shear mode 
+assignment). Starting points are drawn by Latin hypercube sampling within the bounds pmin, 
+pmax and only Born-stable ones (positive definite Cij) are kept (StartPoints, which warns if 
+it finds fewer than nstart; with none at all CijFitMulti raises ValueError). The local 
+fits run in a process pool in two stages: every start first gets a short fit of nfev0 
+evaluations; starts whose cost is above prune times the best cost so far are dropped, and 
+the others are fitted to convergence. The converged solutions are merged into distinct 
+minima (relative distance below tol), refitted once from the solution to get the full 
+FitResult, and returned ranked by chisqr.
+
+Input: VelData (or n, vobs, density via CijFitMulti), sym, pmin, pmax (finite), optional 
+	   nstart, nfev0, prune, tol, processes, seed, sigma, lmfit keywords
+Output: list of FitResult, best first; each has nstarts, the number of starts that ended 
+		in that minimum
+
+*********************************************************************************************
+
+####################
+#Function 8: CijCI #
+####################
+
+Confidence intervals of the fitted constants, as a fast replacement of lmfit conf_interval. 
+The output is the dict of conf_interval, {name: [(prob, value), ...]} from -3 to +3 sigma, 
+so it prints with lmfit report_ci.
+	method='covar':   best +- sigma*stderr from the covariance of the fit (no refits)
+	method='profile': profile likelihood as conf_interval (F-test of chisqr with one 
+	                  constant fixed). Each constant and side is a chain of fixed-constant 
+	                  refits stepped by step*stderr, each warm-started from the previous 
+	                  profile point, and the 2*nvary chains run in a process pool. The 
+	                  crossing of each sigma level is interpolated on the profile.
+
+Input: FitResult of CijFit or CijFitData, optional sigmas, method, step, maxsteps, processes
+Output: dict as lmfit conf_interval
+
+*********************************************************************************************
+
+#############################
+#Function 9: CijFitPlatelets#
+#############################
+
+Joint fit of several platelets of one crystal, each measured in its own lab frame with an 
+unknown orientation. The shared free constants of sym and three Bunge Euler angles per 
+platelet (crystal to lab, degrees, CijRot.EulerRot) are fitted together. Each platelet is a 
+VelData in its lab frame, so its Christoffel basis is prepared once and the crystal tensor 
+is rotated into the lab frame instead (CijRot.RotC1dGrad), which also gives the derivatives 
+of the rotated c1d with respect to the constants and the angles. The Jacobian is block 
+sparse (the angles of a platelet only act on its own rows) and is passed to scipy 
+least_squares as a sparse matrix, so the trust-region solver (lsmr, with tight tolerances 
+so each step is close to exact) never forms the dense problem. Angles of the platelets 
+listed in fixed are held at euler0, e.g. to tie the crystal frame to one platelet of known 
+orientation.
+
+Input: list of VelData (e.g. VelSet.data()), euler0 as (P,3) starting angles, sym, p0, 
+	   optional pmin, pmax, fixed (platelet indices), least_squares keywords
+Output: FitResult-like PlateletFit with names, values, errors, c1d, c1derr, c1dcov, 
+		euler, eulererr as (P,3), covar (constants and free angles), chisqr, redchi, 
+		nfev, time, result (scipy OptimizeResult), data
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import os
+import glob
+import time
+import queue
+import warnings
+import numpy as np
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor
+from lmfit import Parameters, Minimizer
+from scipy.stats import qmc, f as fdist
+from scipy.special import erf, ndtri
+from CijtVel import ChristoffelBasis, Eigsh3
+from CijSij124d import Cij1t2rBatch
+from CijLoad import ReadVel
+from CijRot import EulerRot, RotC1d, RotC1dGrad
+from scipy import sparse
+from scipy.optimize import least_squares
+
+# Names of the c1d elements
+CijNames = ['C11','C22','C33','C44','C55','C66','C12','C13','C23','C15','C25','C35','C46',
+            'C14','C16','C24','C26','C34','C36','C45','C56']
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+class CijSym(object):
+
+    # terms: for each free constant, the c1d elements it sets as [(c1d index, coefficient),...]
+    names = []
+    terms = []
+
+    def __init__(self):
+        self.Map = np.zeros((21, len(self.names)))
+        for j, term in enumerate(self.terms):
+            for i, a in term:
+                self.Map[i,j] += a
+
+    def c1d(self,p):
+        return self.Map.dot(np.asarray(p, dtype=float))
+
+    def p(self,c1d):
+        # free constants of a full c1d (least squares inverse of the map)
+        return np.linalg.lstsq(self.Map, np.asarray(c1d, dtype=float), rcond=None)[0]
+
+    def vector(self,p):
+        # dict or sequence of free constants -> array in the order of names
+        if isinstance(p, dict):
+            return np.array([p[k] for k in self.names], dtype=float)
+        return np.asarray(p, dtype=float)
+
+    def Parameters(self,p0,pmin=None,pmax=None):
+        para = Parameters()
+        p0 = self.vector(p0)
+        pmin = -np.inf*np.ones(len(p0)) if pmin is None else self.vector(pmin)
+        pmax = np.inf*np.ones(len(p0)) if pmax is None else self.vector(pmax)
+        for k, v, lo, hi in zip(self.names, p0, pmin, pmax):
+            para.add(k, value=v, min=lo, max=hi, vary=True)
+        return para
+
+
+class Cubic(CijSym):
+    names = ['C11','C44','C12']
+    terms = [[(0,1),(1,1),(2,1)], [(3,1),(4,1),(5,1)], [(6,1),(7,1),(8,1)]]
+
+
+class Hexagonal(CijSym):
+    names = ['C11','C33','C44','C12','C13']
+    terms = [[(0,1),(1,1),(5,0.5)], [(2,1)], [(3,1),(4,1)], [(6,1),(5,-0.5)], [(7,1),(8,1)]]
+
+
+class Tetragonal(CijSym):
+    names = ['C11','C33','C44','C66','C12','C13']
+    terms = [[(0,1),(1,1)], [(2,1)], [(3,1),(4,1)], [(5,1)], [(6,1)], [(7,1),(8,1)]]
+
+
+class Orthorhombic(CijSym):
+    names = CijNames[:9]
+    terms = [[(i,1)] for i in range(9)]
+
+
+class Monoclinic(CijSym):
+    names = CijNames[:13]
+    terms = [[(i,1)] for i in range(13)]
+
+
+class Triclinic(CijSym):
+    names = CijNames
+    terms = [[(i,1)] for i in range(21)]
+
+
+SymClasses = {'cubic':Cubic, 'hexagonal':Hexagonal, 'tetragonal':Tetragonal,
+              'orthorhombic':Orthorhombic, 'monoclinic':Monoclinic, 'triclinic':Triclinic}
+
+
+def Sym(sym):
+
+    if isinstance(sym, CijSym):
+        return sym
+    return SymClasses[sym.lower()]()
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+def LoadVel(fname):
+
+    d = ReadVel(fname)
+    return d.n, d.vobs
+
+########################################################
+######################Function 3: ######################
+########################################################
+
+def VelMask(vobs,sigma=None):
+
+    # flat indices of the measured velocities (0 = missing) and their weights 1/sigma
+    vobs = np.asarray(vobs, dtype=float)
+    idx = np.flatnonzero(vobs != 0)
+    if sigma is None:
+        sigma = np.ones(vobs.shape)
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), vobs.shape)
+    return idx, 1.0/sigma.ravel()[idx]
+
+
+def ShearMode(vel,vobs):
+
+    # calculated mode index (0 Vp, 1 Vs1, 2 Vs2) compared with each measured velocity;
+    # measured Vs1 and Vs2 each take the closer of the calculated shear waves
+    mode = np.zeros(vobs.shape, dtype=int)
+    mode[:,1:] = 1+np.argmin(abs(vel[:,1:3,None]-vobs[:,None,1:3]), axis=1)
+    return mode
+
+
+def ResVel(c1d,n,vobs,dens,sigma=None):
+
+    return VelData(n, vobs, dens, sigma).res(c1d)
+
+
+def JacVel(c1d,n,vobs,dens,sigma=None):
+
+    return VelData(n, vobs, dens, sigma).jac(c1d)
+
+########################################################
+######################Function 4: ######################
+########################################################
+
+class FitResult(object):
+
+    def __init__(self,sym,result,minimizer,t):
+        self.sym = sym
+        self.result = result
+        self.minimizer = minimizer
+        self.time = t
+        self.names = list(sym.names)
+        self.values = np.array([result.params[k].value for k in self.names])
+        self.errors = np.array([result.params[k].stderr or 0.0 for k in self.names])
+        self.covar = result.covar
+        self.chisqr = result.chisqr
+        self.redchi = result.redchi
+        self.nfev = result.nfev
+        self.c1d = sym.c1d(self.values)
+        self.c1derr = (sym.Map**2).dot(self.errors**2)**0.5
+        # full 21x21 covariance of c1d, for CijVRHCov, UnivAnisoCov and CijtvelCov;
+        # covar is in the order of result.var_names, not of names
+        Mv = sym.Map[:,[self.names.index(k) for k in result.var_names]]
+        self.c1dcov = np.zeros((21,21)) if self.covar is None else Mv.dot(self.covar).dot(Mv.T)
+        self.data = None
+
+
+def ResFit(para,sym,data):
+
+    return data.res(sym.c1d([para[k].value for k in sym.names]))
+
+
+def JacFit(para,sym,data):
+
+    # columns for the varied constants only, in the order of para, as lmfit expects
+    jac = data.jac(sym.c1d([para[k].value for k in sym.names])).dot(sym.Map)
+    return jac[:,[sym.names.index(k) for k in para if para[k].vary]]
+
+
+def CijFit(n,vobs,dens,sym,p0,pmin=None,pmax=None,sigma=None,**kws):
+
+    return CijFitData(VelData(n, vobs, dens, sigma), sym, p0, pmin, pmax, **kws)
+
+
+def CijFitData(data,sym,p0,pmin=None,pmax=None,**kws):
+
+    sym = Sym(sym)
+    if isinstance(p0, Parameters):
+        # JacFit has no chain rule through expr: only fixed or varied constants
+        if sorted(p0) != sorted(sym.names) or any(p0[k].expr for k in p0):
+            raise ValueError('Parameters must hold exactly the constants of sym.names, without expr')
+        para = p0
+    else:
+        para = sym.Parameters(p0, pmin, pmax)
+    opts = dict(ftol=1.0e-15, xtol=1.0e-10)
+    opts.update(kws)
+    t = time.time()
+    minimizer = Minimizer(ResFit, para, fcn_args=(sym, data))
+    result = minimizer.minimize(method='leastsq', Dfun=JacFit, **opts)
+    fit = FitResult(sym, result, minimizer, time.time()-t)
+    fit.data = data
+    return fit
+
+########################################################
+######################Function 5: ######################
+########################################################
+
+class VelData(object):
+
+    def __init__(self,n,vobs,dens,sigma=None):
+        self.n = np.atleast_2d(np.asarray(n, dtype=float))
+        self.n = self.n/np.linalg.norm(self.n, axis=1)[:,None]
+        self.vobs = np.asarray(vobs, dtype=float)
+        self.dens = dens
+        self.sigma = sigma
+        self.idx, self.w = VelMask(self.vobs, sigma)
+        self.basis = ChristoffelBasis(self.n)
+        self.rows = np.arange(len(self.n))[:,None]
+        self.last = None
+
+    def take(self,rows):
+        rows = np.asarray(rows)
+        sub = VelData.__new__(VelData)
+        sub.n = self.n[rows]
+        sub.vobs = self.vobs[rows]
+        sub.dens = self.dens
+        sub.sigma = self.sigma if np.ndim(self.sigma) < 2 else np.asarray(self.sigma)[rows]
+        sub.idx, sub.w = VelMask(sub.vobs, sub.sigma)
+        sub.basis = self.basis[rows]
+        sub.rows = np.arange(len(rows))[:,None]
+        sub.last = None
+        return sub
+
+    def vel(self,c1d):
+        # res and jac of one iteration come at the same c1d: keep the last solve
+        c1d = np.array(c1d, dtype=float)
+        if self.last is not None and np.array_equal(self.last[0], c1d):
+            return self.last[1], self.last[2]
+        E, pol = Eigsh3(self.basis.dot(c1d))
+        vel = (E[:,::-1]/self.dens)**0.5
+        pol = np.swapaxes(pol[:,:,::-1],-1,-2)
+        self.last = (c1d, vel, pol)
+        return vel, pol
+
+    def res(self,c1d):
+        vel, pol = self.vel(c1d)
+        res = vel[self.rows, ShearMode(vel, self.vobs)]-self.vobs
+        return res.ravel()[self.idx]*self.w
+
+    def jac(self,c1d):
+        vel, pol = self.vel(c1d)
+        mode = ShearMode(vel, self.vobs)
+        p = pol[self.rows, mode].reshape(-1,3)[self.idx]
+        m = self.idx//3
+        dE = np.einsum('ri,rikq,rk->rq', p, self.basis[m], p)
+        v = vel[self.rows, mode].ravel()[self.idx]
+        return dE/(2.0*self.dens*v)[:,None]*self.w[:,None]
+
+########################################################
+######################Function 6: ######################
+########################################################
+
+def FileAxis(fname):
+
+    # P/T value from the file name, e.g. input/12.5.dat -> 12.5
+    try:
+        return float(os.path.splitext(os.path.basename(fname))[0])
+    except ValueError:
+        return np.nan
+
+
+def FitFiles(files,pattern='*.dat',axis=None):
+
+    if isinstance(files, str):
+        files = glob.glob(os.path.join(files, pattern)) if os.path.isdir(files) else [files]
+    files = list(files)
+    axis = np.array([FileAxis(f) for f in files] if axis is None else axis, dtype=float)
+    order = np.lexsort((np.array(files), axis))
+    return [files[i] for i in order], axis[order]
+
+
+def FitRow(fname,x,dens,sym,fit):
+
+    row = dict(file=fname, axis=x, dens=dens, chisqr=fit.chisqr, redchi=fit.redchi, 
+               nfev=fit.nfev, time=fit.time, success=fit.result.success)
+    for k, v, e in zip(fit.names, fit.values, fit.errors):
+        row[k] = v
+        row[k+'err'] = e
+    return row
+
+
+def FitSegment(jobs,sym,p0,pmin,pmax,sigma,chain,kws):
+
+    # fit the datasets of one segment in order, warm-starting along the chain; 
+    # each row is yielded as soon as its fit is done
+    sym = Sym(sym)
+    for fname, x, dens in jobs:
+        d = ReadVel(fname)
+        # density and uncertainties from the file unless given
+        dens = d.dens if np.isnan(dens) else dens
+        fit = CijFit(d.n, d.vobs, dens, sym, p0, pmin, pmax, d.sigma if sigma is None else sigma, **kws)
+        yield FitRow(fname, x, dens, sym, fit)
+        if chain and fit.result.success:
+            p0 = fit.values
+
+
+def FitSegmentQueue(jobs,rows,*args):
+
+    # worker: pass every row back through the queue as soon as it is fitted
+    for row in FitSegment(jobs, *args):
+        rows.put(row)
+
+
+def CijFitIter(files,dens,sym,p0,pmin=None,pmax=None,sigma=None,axis=None,chain=False,
+               nchain=None,processes=None,**kws):
+
+    files, axis = FitFiles(files, axis=axis)
+    dens = np.broadcast_to(np.asarray(dens, dtype=float), (len(files),))
+    jobs = list(zip(files, axis, dens))
+    processes = processes or os.cpu_count()
+    if chain:
+        nseg = min(nchain or processes, len(jobs)) or 1
+        segs = [list(j) for j in np.array_split(np.arange(len(jobs)), nseg)]
+        segs = [[jobs[i] for i in seg] for seg in segs]
+    else:
+        segs = [[j] for j in jobs]
+    args = (sym, p0, pmin, pmax, sigma, chain, kws)
+    if processes == 1:
+        for seg in segs:
+            for row in FitSegment(seg, *args):
+                yield row
+        return
+    with Manager() as manager, ProcessPoolExecutor(processes) as pool:
+        rows = manager.Queue()
+        futures = [pool.submit(FitSegmentQueue, seg, rows, *args) for seg in segs]
+        nleft = len(jobs)
+        while nleft:
+            try:
+                row = rows.get(timeout=0.1)
+            except queue.Empty:
+                # a failed worker never sends its rows: raise its error instead of waiting
+                for f in futures:
+                    if f.done() and f.exception() is not None:
+                        raise f.exception()
+                continue
+            nleft -= 1
+            yield row
+
+
+def FitTable(names):
+
+    fields = ['file','axis','dens']+[k+e for k in names for e in ('','err')]
+    fields += ['chisqr','redchi','nfev','time','success']
+    dtype = [(k, 'U256') if k == 'file' else (k, 'i8') if k in ('nfev','success') else (k, 'f8') for k in fields]
+    return fields, dtype
+
+
+def CijFitBatch(files,dens,sym,p0,pmin=None,pmax=None,sigma=None,axis=None,chain=False,
+                nchain=None,processes=None,out=None,**kws):
+
+    fields, dtype = FitTable(Sym(sym).names)
+    rows = []
+    fo = open(out, 'w') if out else None
+    try:
+        if fo:
+            fo.write('\t'.join(fields)+'\n')
+            fo.flush()
+        for row in CijFitIter(files, dens, sym, p0, pmin, pmax, sigma, axis, chain, 
+                              nchain, processes, **kws):
+            rows.append(tuple(row[k] for k in fields))
+            if fo:
+                fo.write('\t'.join(str(row[k]) for k in fields)+'\n')
+                fo.flush()
+    finally:
+        if fo:
+            fo.close()
+    res = np.array(rows, dtype=dtype)
+    return res[np.argsort(res['axis'], kind='stable')]
+
+########################################################
+######################Function 7: ######################
+########################################################
+
+def StartPoints(sym,pmin,pmax,nstart,seed=None):
+
+    sym = Sym(sym)
+    pmin = sym.vector(pmin)
+    pmax = sym.vector(pmax)
+    if not (np.all(np.isfinite(pmin)) and np.all(np.isfinite(pmax))):
+        raise ValueError('finite pmin and pmax are needed to draw starting points')
+    if nstart < 1:
+        raise ValueError('nstart must be at least 1')
+    sampler = qmc.LatinHypercube(d=len(pmin), seed=seed)
+    p0 = np.zeros((0,len(pmin)))
+    # oversample until enough starts are Born-stable (positive definite Cij)
+    for i in range(20):
+        p = qmc.scale(sampler.random(4*nstart), pmin, pmax)
+        stable = np.all(np.linalg.eigvalsh(Cij1t2rBatch(p.dot(sym.Map.T))) > 0, axis=1)
+        p0 = np.vstack((p0, p[stable]))
+        if len(p0) >= nstart:
+            break
+    if len(p0) < nstart:
+        warnings.warn('only %d of %d starting points are Born-stable within pmin, pmax'
+                      % (len(p0), nstart))
+    return p0[:nstart]
+
+
+def FitStart(data,sym,p0,pmin,pmax,kws):
+
+    # worker: one local fit, returns plain arrays only
+    fit = CijFitData(data, sym, p0, pmin, pmax, **kws)
+    return fit.values, fit.chisqr, fit.nfev
+
+
+def FitPool(data,sym,p0,pmin,pmax,kws,processes):
+
+    if processes == 1:
+        return [FitStart(data, sym, p, pmin, pmax, kws) for p in p0]
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(FitStart, data, sym, p, pmin, pmax, kws) for p in p0]
+        return [f.result() for f in futures]
+
+
+def CijFitMulti(n,vobs,dens,sym,pmin,pmax,sigma=None,**kws):
+
+    return CijFitMultiData(VelData(n, vobs, dens, sigma), sym, pmin, pmax, **kws)
+
+
+def CijFitMultiData(data,sym,pmin,pmax,nstart=64,nfev0=20,prune=10.0,tol=1.0e-4,
+                    processes=None,seed=None,**kws):
+
+    sym = Sym(sym)
+    pmin = sym.vector(pmin)
+    pmax = sym.vector(pmax)
+    processes = processes or os.cpu_count()
+    p0 = StartPoints(sym, pmin, pmax, nstart, seed)
+    if len(p0) == 0:
+        raise ValueError('no Born-stable starting point within pmin, pmax (nstart=%d)' % nstart)
+    # stage 1: short fits, prune the starts clearly dominated by the best one
+    short = dict(kws)
+    short['max_nfev'] = nfev0
+    stage = FitPool(data, sym, p0, pmin, pmax, short, processes)
+    cost = np.array([c for v, c, nf in stage])
+    keep = cost <= prune*max(cost.min(), np.finfo(float).tiny)
+    p1 = np.array([v for v, c, nf in stage])[keep]
+    # stage 2: converge the survivors
+    stage = FitPool(data, sym, p1, pmin, pmax, kws, processes)
+    vals = np.array([v for v, c, nf in stage])
+    cost = np.array([c for v, c, nf in stage])
+    # distinct minima, best first
+    fits = []
+    for i in np.argsort(cost):
+        for fit in fits:
+            if np.linalg.norm(vals[i]-fit.values) <= tol*np.linalg.norm(fit.values):
+                fit.nstarts += 1
+                break
+        else:
+            fit = CijFitData(data, sym, vals[i], pmin, pmax, **kws)
+            fit.nstarts = 1
+            fits.append(fit)
+    fits.sort(key=lambda fit: fit.chisqr)
+    return fits
+
+########################################################
+######################Function 8: ######################
+########################################################
+
+def ProfileChain(data,sym,values,vary,pmin,pmax,j,x,kws):
+
+    # worker: refit with constant j fixed at each x in turn, warm-started along the chain
+    sym = Sym(sym)
+    p0 = np.array(values, dtype=float)
+    chisqr = np.zeros(len(x))
+    for i, xi in enumerate(x):
+        p0[j] = xi
+        para = sym.Parameters(p0, pmin, pmax)
+        for k, v in zip(sym.names, vary):
+            para[k].vary = v
+        para[sym.names[j]].vary = False
+        fit = CijFitData(data, sym, para, **kws)
+        chisqr[i] = fit.chisqr
+        p0 = fit.values
+    return chisqr
+
+
+def CijCI(fit,sigmas=(1,2,3),method='profile',step=0.5,maxsteps=20,processes=None,**kws):
+
+    if method not in ('covar', 'profile'):
+        raise ValueError("method must be 'covar' or 'profile'")
+    sym = fit.sym
+    para = fit.result.params
+    vary = [para[k].vary for k in sym.names]
+    sigmas = np.sort(np.asarray(sigmas, dtype=float))
+    probs = erf(sigmas/2.0**0.5)
+    ci = {}
+    if method == 'covar':
+        for k, v, e, var in zip(sym.names, fit.values, fit.errors, vary):
+            if var:
+                ci[k] = ([(p, v-s*e) for s, p in zip(sigmas[::-1], probs[::-1])]+[(0.0, v)]
+                         +[(p, v+s*e) for s, p in zip(sigmas, probs)])
+        return ci
+    if fit.data is None:
+        raise ValueError('profile intervals need the fitted VelData (fit.data)')
+    pmin = np.array([para[k].min for k in sym.names])
+    pmax = np.array([para[k].max for k in sym.names])
+    nfree = fit.result.nfree
+    # profile grid: enough steps of the standard error to pass the largest sigma
+    nsteps = min(int(np.ceil(1.5*sigmas[-1]/step))+1, maxsteps)
+    chains = []
+    for j, (e, var) in enumerate(zip(fit.errors, vary)):
+        if var:
+            for side in (-1, 1):
+                x = fit.values[j]+side*step*max(e, 1.0e-8*abs(fit.values[j]))*np.arange(1, nsteps+1)
+                chains.append((j, side, np.clip(x, pmin[j], pmax[j])))
+    args = (fit.data, sym, fit.values, vary, pmin, pmax)
+    processes = processes or os.cpu_count()
+    if processes == 1:
+        prof = [ProfileChain(*(args+(j, x, kws))) for j, side, x in chains]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(ProfileChain, *(args+(j, x, kws))) for j, side, x in chains]
+            prof = [f.result() for f in futures]
+    for (j, side, x), chisqr in zip(chains, prof):
+        k = sym.names[j]
+        # F-test probability of each profile point, as lmfit conf_interval
+        dchi = np.maximum(chisqr/fit.chisqr-1.0, 0.0)
+        prob = fdist.cdf(dchi*nfree, 1, nfree)
+        # sigma equivalent of the probability is close to linear in x: interpolate in it
+        z = np.maximum.accumulate(ndtri(np.clip((1.0+prob)/2.0, 0.5, 1.0-1.0e-16)))
+        z = np.concatenate(([0.0], z))
+        x = np.concatenate(([fit.values[j]], x))
+        lim = [(p, np.interp(sg, z, x, right=np.nan)) for sg, p in zip(sigmas, probs)]
+        if side < 0:
+            ci[k] = lim[::-1]+[(0.0, fit.values[j])]
+        else:
+            ci[k] = ci[k]+lim
+    return {k: ci[k] for k in sym.names if k in ci}
+
+########################################################
+######################Function 9: ######################
+########################################################
+
+class PlateletFit(object):
+
+    def __init__(self,sym,result,euler,free,data,t):
+        self.sym = sym
+        self.result = result
+        self.data = data
+        self.time = t
+        self.names = list(sym.names)
+        np_ = len(self.names)
+        self.values = result.x[:np_]
+        self.euler = euler
+        self.chisqr = 2.0*result.cost
+        nfree = len(result.fun)-len(result.x)
+        self.redchi = self.chisqr/max(nfree, 1)
+        self.nfev = result.nfev
+        J = result.jac.toarray() if sparse.issparse(result.jac) else result.jac
+        try:
+            self.covar = np.linalg.inv(J.T.dot(J))*self.redchi
+        except np.linalg.LinAlgError:
+            self.covar = None
+        err = np.zeros(len(result.x)) if self.covar is None else np.diag(self.covar)**0.5
+        self.errors = err[:np_]
+        self.eulererr = np.zeros(euler.shape)
+        self.eulererr[free] = err[np_:].reshape(-1,3)
+        self.c1d = sym.c1d(self.values)
+        self.c1derr = (sym.Map**2).dot(self.errors**2)**0.5
+        self.c1dcov = np.zeros((21,21)) if self.covar is None else sym.Map.dot(self.covar[:np_,:np_]).dot(sym.Map.T)
+
+
+def CijFitPlatelets(data,euler0,sym,p0,pmin=None,pmax=None,fixed=(),**kws):
+
+    sym = Sym(sym)
+    P = len(data)
+    np_ = len(sym.names)
+    euler = np.array(euler0, dtype=float).reshape(P,3)
+    free = np.array([k not in fixed for k in range(P)])
+    p0 = sym.vector(p0)
+    lo = np.concatenate((-np.inf*np.ones(np_) if pmin is None else sym.vector(pmin), -np.inf*np.ones(3*free.sum())))
+    hi = np.concatenate((np.inf*np.ones(np_) if pmax is None else sym.vector(pmax), np.inf*np.ones(3*free.sum())))
+    nrow = [len(d.idx) for d in data]
+
+    def Unpack(x):
+        e = euler.copy()
+        e[free] = x[np_:].reshape(-1,3)
+        return sym.c1d(x[:np_]), e
+
+    def Res(x):
+        c1d, e = Unpack(x)
+        c1dr = RotC1d(c1d, EulerRot(e))
+        return np.concatenate([d.res(c) for d, c in zip(data, c1dr)])
+
+    def Jac(x):
+        c1d, e = Unpack(x)
+        c1dr, T, dc = RotC1dGrad(c1d, e)
+        cij = []
+        ang = []
+        for k, d in enumerate(data):
+            J = d.jac(c1dr[k])
+            cij.append(J.dot(T[k]).dot(sym.Map))
+            if free[k]:
+                ang.append(J.dot(dc[k]))
+            else:
+                ang.append(np.zeros((nrow[k],0)))
+        return sparse.hstack((sparse.csr_matrix(np.vstack(cij)), sparse.block_diag(ang, format='csr'))).tocsr()
+
+    # tight lsmr tolerances: near-exact steps, a few iterations as with leastsq
+    opts = dict(method='trf', x_scale='jac', ftol=1.0e-12, xtol=1.0e-10, tr_solver='lsmr',
+                tr_options=dict(atol=1.0e-12, btol=1.0e-12))
+    opts.update(kws)
+    t = time.time()
+    x0 = np.concatenate((p0, euler[free].ravel()))
+    result = least_squares(Res, x0, jac=Jac, bounds=(lo, hi), **opts)
+    c1d, e = Unpack(result.x)
+    return PlateletFit(sym, result, e, free, data, time.time()-t)
+
@@ -44,12 +44,62 @@ Calculate aggregate elastic properties K, G, Vp and Vs from single-crystal elast
 the form of 1D array and density
 
 K and G are calculated based on the HS averaging scheme:
+Hashin-Shtrikman bounds of a random polycrystal of any symmetry (Brown 2015). For an isotropic 
+comparison medium (K0,G0) the HS estimate of the aggregate is
+	K = 1/(3*aJ) - K*,   G = 1/(2*aK) - G*,   K* = 4/3*G0,   G* = G0*(9*K0+8*G0)/(6*(K0+2*G0))
+where aJ and aK are the isotropic parts of (Cij+C*)^-1 in Mandel notation. It is a lower bound 
+when Cij-C0 is positive semi-definite and an upper bound when C0-Cij is. The bounds are tightest 
+on the edge of these admissible regions, which is traced with the generalized eigenvalues of 
+(Cij, C0) along the direction theta of (K0,G0) = s*(cos(theta),sin(theta)). The best theta is 
+found on a coarse grid and refined iteratively by golden-section search, for all tensors at once.
+For cubic crystals this reproduces the classic Hashin and Shtrikman (1962) bounds.
+Errors follow the same propagation as CijVRH.
 
 Input: c1d and c1derr both as 1x21 1D array, density and density error
 
 Output: Aggregate elastic properties in the form of 2x9 2D array
-	[dens,Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs]
-	[denserr,Kvrherrb,Kvrherrb,Kvrherr,Gvrherrb,Gvrherrb,Gvrherr,Vperr,Vserr]
+	[dens,Ku,Kl,Khs,Gu,Gl,Ghs,Vp,Vs]
+	[denserr,Kvrherrb,Kvrherrb,Khserr,Gvrherrb,Gvrherrb,Ghserr,Vperr,Vserr]
+	Ku, Gu are the HS upper bounds (in place of Kv, Gv), Kl, Gl the HS lower bounds (in place of 
+	Kr, Gr) and Khs, Ghs their averages.
+	cijHSBatch does the same for (N,21) stacks and returns a structured array (HSdtype).
+
+*********************************************************************************************
+
+##########################
+#Function 3: CijVRHBatch#
+##########################
+
+Same as CijVRH for a stack of N tensors: one batched 6x6 inversion and array arithmetic 
+instead of a Python loop over CijVRH.
+
+Input: c1d and c1derr both as (N,21) 2D array, density and density error as (N,) arrays 
+	   (or scalars)
+Output: structured array of shape (N,) with dtype VRHdtype, fields
+	dens,Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs,
+	denserr,Kverr,Krerr,Kvrherr,Gverr,Grerr,Gvrherr,Vperr,Vserr
+	e.g. res['Kvrh'], res['Gvrherr']. Kverr and Krerr hold the same Kvrherrb as in CijVRH.
+
+*********************************************************************************************
+######################################
+#Function 4: CijVRHJac and CijVRHCov#
+######################################
+
+Exact first-order (linear) error propagation with the full covariance of the elastic constants, 
+vectorized over stacks of tensors. CijVRHJac returns the analytic Jacobian of 
+[Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs] with respect to the 21 constants of c1d and density (22 columns). 
+The Reuss terms use dS = -S.dC.S, e.g. dKr/dCab = Kr**2*(S.W.S)ab with W the weights of the 
+Sij in 1/Kr, and off-diagonal Cab count twice because Cab and Cba are the same c1d element.
+CijVRHCov propagates a 21x21 covariance of c1d (e.g. FitResult.c1dcov) and the density error:
+cov(Y) = J.cov.J^T. Unlike CijVRH, no independence between the Cij or between K and G is 
+assumed, and Kv, Kr, Gv, Gr get their own errors. The VRH spread |Kv-Kr|/2, |Gv-Gr|/2 that 
+CijVRH adds to Kvrherr and Gvrherr is added only with spread=True.
+
+Input: c1d as 1x21 or (N,21) array, density (scalar or (N,)); CijVRHCov also cov as 21x21 or 
+	   (N,21,21) array and density error
+Output: CijVRHJac: values (N,8) and jac (N,8,22)
+		CijVRHCov: structured array (N,) with dtype VRHdtype as CijVRHBatch, and the (N,8,8) 
+		covariance of [Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs]
 
 *********************************************************************************************
 Redistribution and use in source and binary forms, with or without modification, are permitted 
@@ -80,114 +130,245 @@ All rights reserved.
 @author: ZhangJin
 """
 import numpy as np
-from CijSij124d import Cij1t2r, Cij2t4r, C1dts2d, C1dts1d
+from CijSij124d import Cij1t2r, Cij2t4r, C1dts2d, C1dts1d, C1dts2dBatch, Cij1t2rBatch, VoigtRow, VoigtCol
 
 ########################################################
 ######################Function 1: ######################
 ########################################################
 
 
+VRHnames = ['dens','Kv','Kr','Kvrh','Gv','Gr','Gvrh','Vp','Vs']
+VRHdtype = np.dtype([(k, float) for k in VRHnames]+[(k+'err', float) for k in VRHnames])
+
+
 def CijVRH(c1d,c1derr,dens,denserr):
     
-    s2r = C1dts2d (c1d)
-	
-    #cubic: c11=c22=c33, c44=c55=c66,c12=c13=c23, 3 cosntants
-    #tetragonal: c11=c22 c23=c13 c44=c55 6 constants
-    c11 = c1d[0]#c11
-    c22 = c1d[1]#c22
-    c33 = c1d[2]#c33
-    c44 = c1d[3]#c44
-    c55 = c1d[4]#c55
-    c66 = c1d[5]#c66
-    c12 = c1d[6]#c12
-    c13 = c1d[7]#c13
-    c23 = c1d[8]#c23
-	#Ortho:9constants; 
-    c15 = c1d[9]#c15
-    c25 = c1d[10]#c25
-    c35 = c1d[11]#c35
-    c46 = c1d[12]#c46
-    #Mono: 13 constants; 	
-    c14 = c1d[13]#c14
-    c16 = c1d[14]#c16
-    c24 = c1d[15]#c24
-    c26 = c1d[16]#c26
-    c34 = c1d[17]#c34
-    c36 = c1d[18]#c36
-    c45 = c1d[19]#c45
-    c56 = c1d[20]#c56
-	
-	#Cij error input
-    c11err = c1derr[0]
-    c22err = c1derr[1]
-    c33err = c1derr[2]
-    c44err = c1derr[3]
-    c55err = c1derr[4]
-    c66err = c1derr[5]
-    c12err = c1derr[6]
-    c13err = c1derr[7]
-    c23err = c1derr[8]
-    c15err = c1derr[9]
-    c25err = c1derr[10]
-    c35err = c1derr[11]
-    c46err = c1derr[12]
-    c14err = c1derr[13]
-    c16err = c1derr[14]
-    c24err = c1derr[15]
-    c26err = c1derr[16]
-    c34err = c1derr[17]
-    c36err = c1derr[18]
-    c45err = c1derr[19]
-    c56err = c1derr[20]
-	
-    Kv = 1.0/9.0*((c11+c22+c33) + 2.0*(c12+c23+c13))
-    Gv = 1.0/15.0*((c11+c22+c33) - (c12+c23+c13) + 3.0*(c44+c55+c66))
-	
-	#cubic 3 constants; tetragonal 6 constants
-    s11 = s2r[0,0] #s11
-    s22 = s2r[1,1] #s22
-    s33 = s2r[2,2] #s33
-    s44 = s2r[3,3] #s44
-    s55 = s2r[4,4] #s55
-    s66 = s2r[5,5] #s66
-    s12 = s2r[0,1] #s12
-    s13 = s2r[0,2] #s13
-    s23 = s2r[1,2] #s23
-	#Ortho:9 constants; 
-    s15 = s2r[0,4] #s15
-    s25 = s2r[1,4] #s25
-    s35 = s2r[2,4] #s35
-    s46 = s2r[3,5] #s46
-    #Mono: 13 constants; 	
-    s14 = s2r[0,3] #s14
-    s16 = s2r[0,5] #s16
-    s24 = s2r[1,3] #s24
-    s26 = s2r[1,5] #s26
-    s34 = s2r[2,3] #s34
-    s36 = s2r[2,5] #s36
-    s45 = s2r[3,4] #s45
-    s56 = s2r[4,5] #s56
-    #Triclinic:21constants;  
-	
-    Kr = 1.0/((s11+s22+s33)+2.0*(s12+s13+s23))
-    Gr = 15.0/(4.0*(s11+s22+s33) - 4.0*(s12+s13+s23) + 3.0*(s44+s55+s66))
-	
+    # an ElasticTensor (CijTensor) keeps the error-free result for its own density
+    if hasattr(c1d, 'vrh') and dens == c1d.dens and denserr == 0 and not np.any(c1derr):
+        return c1d.vrh.copy()
+    res = CijVRHBatch(c1d, np.reshape(c1derr,(1,21)), dens, denserr)[0]
+    
+    Evrh = np.array ([[res[k] for k in VRHnames],[res[k+'err'] for k in VRHnames]])
+    
+    return Evrh
+
+########################################################
+######################Function 3: ######################
+########################################################
+
+
+def CijVRHBatch(c1d,c1derr,dens,denserr):
+    
+    # s2r first, so an ElasticTensor (CijTensor) passed as c1d brings its cached inverse
+    s2r = C1dts2dBatch (c1d).reshape(-1,6,6)
+    c1d = np.asarray(c1d, dtype=float).reshape(-1,21)
+    c1derr = np.asarray(c1derr, dtype=float).reshape(-1,21)
+    dens, denserr = np.broadcast_arrays(np.asarray(dens, dtype=float), np.asarray(denserr, dtype=float))
+    
+    # c11,c22,c33,c44,c55,c66,c12,c13,c23 are c1d[:,0:9]; s11...s23 the same 9 positions of s2r
+    c = c1d[:,:9]
+    cerr = c1derr[:,:9]
+    s = s2r[:,[0,1,2,3,4,5,0,0,1],[0,1,2,3,4,5,1,2,2]]
+    
+    Kv = 1.0/9.0*(c[:,0:3].sum(1) + 2.0*c[:,6:9].sum(1))
+    Gv = 1.0/15.0*(c[:,0:3].sum(1) - c[:,6:9].sum(1) + 3.0*c[:,3:6].sum(1))
+    Kr = 1.0/(s[:,0:3].sum(1)+2.0*s[:,6:9].sum(1))
+    Gr = 15.0/(4.0*s[:,0:3].sum(1) - 4.0*s[:,6:9].sum(1) + 3.0*s[:,3:6].sum(1))
+    
     Kvrh = (Kr+Kv)/2.0
     Gvrh = (Gr+Gv)/2.0
-     
+    
+    e2 = cerr**2
     Kvrherra = np.absolute(Kv-Kr)/2.0 
-    Kvrherrb = ((c11err**2+c22err**2+c33err**2+4.0*(c12err**2+c13err**2+c23err**2))/81.0)**0.5
+    Kvrherrb = ((e2[:,0:3].sum(1)+4.0*e2[:,6:9].sum(1))/81.0)**0.5
     Kvrherr = Kvrherra + (1.0/4.0*Kvrherrb**2+1.0/4.0*Kvrherrb**2)**0.5
     Gvrherra = np.absolute(Gv-Gr)/2.0 
-    Gvrherrb = ((c11err**2+c22err**2+c33err**2+c12err**2+c13err**2+c23err**2+9.0*(c44err**2+c55err**2+c66err**2))/225.0)**0.5
+    Gvrherrb = ((e2[:,0:3].sum(1)+e2[:,6:9].sum(1)+9.0*e2[:,3:6].sum(1))/225.0)**0.5
     Gvrherr = Gvrherra + (1.0/4.0*Gvrherrb**2+1.0/4.0*Gvrherrb**2)**0.5
     
     Vp = ((Kvrh+4.0/3.0*Gvrh)/dens)**0.5
     Vperr = Vp/2.0*((Kvrherr**2+16.0/9.0*Gvrherr**2)/(Kvrh+4.0/3.0*Gvrh)**2+denserr**2/dens**2)**0.5
     Vs = (Gvrh/dens)**0.5
     Vserr = Vs/2.0*(Gvrherr**2/Gvrh**2+denserr**2/dens**2)**0.5
-	
-    Evrh = np.array ([[dens,Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs],[denserr,Kvrherrb,Kvrherrb,Kvrherr,Gvrherrb,Gvrherrb,Gvrherr,Vperr,Vserr]])
     
-    return Evrh
-	
+    res = np.zeros(len(c1d), dtype=VRHdtype)
+    for k, v in zip(VRHdtype.names, (dens,Kv,Kr,Kvrh,Gv,Gr,Gvrh,Vp,Vs,
+                                     denserr,Kvrherrb,Kvrherrb,Kvrherr,Gvrherrb,Gvrherrb,Gvrherr,Vperr,Vserr)):
+        res[k] = v
+    
+    return res
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+HSnames = ['dens','Ku','Kl','Khs','Gu','Gl','Ghs','Vp','Vs']
+HSdtype = np.dtype([(k, float) for k in HSnames]+[(k+'err', float) for k in HSnames])
+
+# Isotropic projectors and the Voigt to Mandel scaling
+Jm = np.zeros((6,6))
+Jm[:3,:3] = 1.0/3.0
+Km = np.eye(6)-Jm
+Mandel = np.array([1.0,1.0,1.0,2.0**0.5,2.0**0.5,2.0**0.5])
+
+
+def HSest(M,theta,upper):
+    
+    # HS estimate with the comparison medium on the edge of the admissible region along theta
+    # M: (N,6,6) Cij in Mandel notation, theta: (N,) or (N,T)
+    M = M.reshape(M.shape[:1]+(1,)*(theta.ndim-1)+(6,6))
+    a = np.cos(theta)[...,None,None]
+    b = np.sin(theta)[...,None,None]
+    Bh = Jm/(3.0*a)**0.5+Km/(2.0*b)**0.5
+    lam = np.linalg.eigvalsh(Bh @ M @ Bh)
+    s = lam[...,-1] if upper else lam[...,0]
+    K0 = s*np.cos(theta)
+    G0 = s*np.sin(theta)
+    Ks = 4.0/3.0*G0
+    Gs = G0*(9.0*K0+8.0*G0)/(6.0*(K0+2.0*G0))
+    A = np.linalg.inv(M+3.0*Ks[...,None,None]*Jm+2.0*Gs[...,None,None]*Km)
+    aJ = A[...,:3,:3].sum((-1,-2))/3.0
+    aK = (np.trace(A, axis1=-2, axis2=-1)-aJ)/5.0
+    return 1.0/(3.0*aJ)-Ks, 1.0/(2.0*aK)-Gs
+
+
+def HSbound(M,upper,ngrid=16,niter=30):
+    
+    N = len(M)
+    th = np.linspace(0.0, np.pi/2.0, ngrid+2)[1:-1]
+    step = th[1]-th[0]
+    gr = (5.0**0.5-1.0)/2.0
+    Kg, Gg = HSest(M, np.tile(th,(N,1)), upper)
+    bound = []
+    for idx, f in enumerate((Kg, Gg)):
+        # golden-section search around the best grid point; minimize -f for the lower bound
+        sgn = 1.0 if upper else -1.0
+        best = np.argmin(sgn*f, 1)
+        lo = np.maximum(th[best]-step, 1e-9)
+        hi = np.minimum(th[best]+step, np.pi/2.0-1e-9)
+        x1 = hi-gr*(hi-lo)
+        x2 = lo+gr*(hi-lo)
+        f1 = sgn*HSest(M, x1, upper)[idx]
+        f2 = sgn*HSest(M, x2, upper)[idx]
+        for i in range(niter):
+            left = f1 < f2
+            hi = np.where(left, x2, hi)
+            lo = np.where(left, lo, x1)
+            xn = np.where(left, hi-gr*(hi-lo), lo+gr*(hi-lo))
+            fn = sgn*HSest(M, xn, upper)[idx]
+            x1, x2, f1, f2 = (np.where(left, xn, x2), np.where(left, x1, xn),
+                              np.where(left, fn, f2), np.where(left, f1, fn))
+        bound.append(sgn*np.minimum(np.minimum(f1, f2), (sgn*f).min(1)))
+    return bound
+
+
+def cijHS(c1d,c1derr,dens,denserr):
+    
+    res = cijHSBatch(np.reshape(c1d,(1,21)), np.reshape(c1derr,(1,21)), dens, denserr)[0]
+    
+    Ehs = np.array ([[res[k] for k in HSnames],[res[k+'err'] for k in HSnames]])
+    
+    return Ehs
+
+
+def cijHSBatch(c1d,c1derr,dens,denserr):
+    
+    c1d = np.asarray(c1d, dtype=float)
+    c1derr = np.asarray(c1derr, dtype=float)
+    dens, denserr = np.broadcast_arrays(np.asarray(dens, dtype=float), np.asarray(denserr, dtype=float))
+    M = Cij1t2rBatch(c1d)*Mandel[:,None]*Mandel[None,:]
+    
+    Ku, Gu = HSbound(M, True)
+    Kl, Gl = HSbound(M, False)
+    Khs = (Ku+Kl)/2.0
+    Ghs = (Gu+Gl)/2.0
+    
+    e2 = c1derr**2
+    Kvrherrb = ((e2[:,0:3].sum(1)+4.0*e2[:,6:9].sum(1))/81.0)**0.5
+    Khserr = np.absolute(Ku-Kl)/2.0 + (1.0/4.0*Kvrherrb**2+1.0/4.0*Kvrherrb**2)**0.5
+    Gvrherrb = ((e2[:,0:3].sum(1)+e2[:,6:9].sum(1)+9.0*e2[:,3:6].sum(1))/225.0)**0.5
+    Ghserr = np.absolute(Gu-Gl)/2.0 + (1.0/4.0*Gvrherrb**2+1.0/4.0*Gvrherrb**2)**0.5
+    
+    Vp = ((Khs+4.0/3.0*Ghs)/dens)**0.5
+    Vperr = Vp/2.0*((Khserr**2+16.0/9.0*Ghserr**2)/(Khs+4.0/3.0*Ghs)**2+denserr**2/dens**2)**0.5
+    Vs = (Ghs/dens)**0.5
+    Vserr = Vs/2.0*(Ghserr**2/Ghs**2+denserr**2/dens**2)**0.5
+    
+    res = np.zeros(len(c1d), dtype=HSdtype)
+    for k, v in zip(HSdtype.names, (dens,Ku,Kl,Khs,Gu,Gl,Ghs,Vp,Vs,
+                                    denserr,Kvrherrb,Kvrherrb,Khserr,Gvrherrb,Gvrherrb,Ghserr,Vperr,Vserr)):
+        res[k] = v
+    
+    return res
+
+########################################################
+######################Function 4: ######################
+########################################################
+
+# weights of the Sij (upper 3x3 block, 44 55 66) in 1/Kr and 15/Gr
+WKr = np.zeros((6,6))
+WKr[:3,:3] = 1.0
+WGr = np.zeros((6,6))
+WGr[:3,:3] = -2.0
+WGr[[0,1,2],[0,1,2]] = 4.0
+WGr[[3,4,5],[3,4,5]] = 3.0
+
+
+def CijVRHJac(c1d,dens):
+    
+    s2r = C1dts2dBatch (c1d).reshape(-1,6,6)
+    c1d = np.asarray(c1d, dtype=float).reshape(-1,21)
+    N = len(c1d)
+    dens = np.broadcast_to(np.asarray(dens, dtype=float), (N,))
+    res = CijVRHBatch(c1d, np.zeros((N,21)), dens, np.zeros(N))
+    vals = np.stack([res[k] for k in VRHnames[1:]], axis=1)
+    # c1d element q sits at (VoigtRow[q],VoigtCol[q]) and (VoigtCol[q],VoigtRow[q])
+    f = np.where(VoigtRow == VoigtCol, 1.0, 2.0)
+    jac = np.zeros((N,8,22))
+    jac[:,0,:3] = 1.0/9.0
+    jac[:,0,6:9] = 2.0/9.0
+    jac[:,3,:3] = 1.0/15.0
+    jac[:,3,6:9] = -1.0/15.0
+    jac[:,3,3:6] = 3.0/15.0
+    SWS = s2r @ WKr @ s2r
+    jac[:,1,:21] = f*SWS[:,VoigtRow,VoigtCol]*(res['Kr']**2)[:,None]
+    SWS = s2r @ WGr @ s2r
+    jac[:,4,:21] = f*SWS[:,VoigtRow,VoigtCol]*(res['Gr']**2/15.0)[:,None]
+    jac[:,2] = (jac[:,0]+jac[:,1])/2.0
+    jac[:,5] = (jac[:,3]+jac[:,4])/2.0
+    Vp = res['Vp']
+    Vs = res['Vs']
+    jac[:,6] = (jac[:,2]+4.0/3.0*jac[:,5])/(2.0*dens*Vp)[:,None]
+    jac[:,7] = jac[:,5]/(2.0*dens*Vs)[:,None]
+    jac[:,6,21] = -Vp/(2.0*dens)
+    jac[:,7,21] = -Vs/(2.0*dens)
+    return vals, jac
+
+
+def CovC1dDens(cov,denserr,N):
+    
+    # 22x22 covariance of [c1d, dens], density independent of the Cij
+    covf = np.zeros((N,22,22))
+    covf[:,:21,:21] = cov
+    covf[:,21,21] = np.asarray(denserr, dtype=float)**2
+    return covf
+
+
+def CijVRHCov(c1d,cov,dens,denserr,spread=False):
+    
+    vals, jac = CijVRHJac(c1d, dens)
+    N = len(vals)
+    covy = jac @ CovC1dDens(cov, denserr, N) @ np.swapaxes(jac,1,2)
+    err = np.diagonal(covy, axis1=1, axis2=2)**0.5
+    if spread:
+        err = err.copy()
+        err[:,2] += np.absolute(vals[:,0]-vals[:,1])/2.0
+        err[:,5] += np.absolute(vals[:,3]-vals[:,4])/2.0
+    res = np.zeros(N, dtype=VRHdtype)
+    res['dens'] = np.broadcast_to(dens, (N,))
+    res['denserr'] = np.broadcast_to(denserr, (N,))
+    for i, k in enumerate(VRHnames[1:]):
+        res[k] = vals[:,i]
+        res[k+'err'] = err[:,i]
+    return res, covy
+
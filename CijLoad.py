@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass, cached loader for Brillouin and ultrasonic velocity datasets
+
+*********************************************************************************************
+
+#####################
+#Function 1: ReadVel#
+#####################
+
+Parse a velocity file such as cubic/input/0.dat once into a VelSet. The text format is 
+whitespace separated columns
+	nx ny nz Vp Vs1 Vs2                              (6 columns)
+	nx ny nz Vp Vs1 Vs2 sVp sVs1 sVs2                (9 columns, 1-sigma uncertainties)
+with velocities and uncertainties in m/s. A velocity of 0 or nan was not measured. Lines 
+starting with # are comments; comments of the form "# key = value" (or "key: value") are 
+read as metadata, e.g. "# dens = 3.709", "# P = 10.2", "# T = 300"; numeric values are 
+converted to float.
+The parsed arrays are kept in a binary sidecar <file>.npz next to the text file, tagged with 
+the mtime and size of the text file; the next ReadVel loads the sidecar instead of parsing 
+the text again unless the file has changed. A sidecar that cannot be written (read-only 
+directory) is skipped silently; it is written to a temporary file and renamed into place, and 
+one that cannot be read (e.g. truncated) is treated as missing and rewritten.
+
+Input: file name, optional cache (default True)
+Output: VelSet with
+	fname        the file name
+	table        structured array with the columns nx, ny, nz, Vp, Vs1, Vs2, sVp, sVs1, sVs2 
+	             (km/s, nan where not given)
+	n            (M,3) phonon directions
+	vobs         (M,3) velocities in km/s, 0 where not measured (as VelMask expects)
+	mask         (M,3) bool, True where measured
+	sigma        (M,3) uncertainties in km/s, or None without uncertainty columns; a missing, 
+	             nan or non-positive uncertainty is replaced by the median of the valid ones 
+	             of its column (ValueError if a column with measured velocities has none)
+	meta         dict of the metadata; dens, P, T properties (None if not given)
+	data(dens=None) -> VelData for CijFitData, density from meta if not given
+
+*********************************************************************************************
+
+#####################
+#Function 2: ReadDir#
+#####################
+
+ReadVel for every file of a directory matching pattern (default *.dat), sorted by name.
+
+Input: directory, optional pattern, cache
+Output: list of VelSet
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import os
+import glob
+import json
+import numpy as np
+
+VelColumns = ['nx','ny','nz','Vp','Vs1','Vs2','sVp','sVs1','sVs2']
+VelDtype = [(k, float) for k in VelColumns]
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+class VelSet(object):
+
+    def __init__(self,fname,table,meta):
+        self.fname = fname
+        self.table = table
+        self.meta = meta
+        self.n = np.stack([table[k] for k in VelColumns[:3]], axis=1)
+        v = np.stack([table[k] for k in VelColumns[3:6]], axis=1)
+        self.mask = np.isfinite(v) & (v != 0)
+        self.vobs = np.where(self.mask, v, 0.0)
+        s = np.stack([table[k] for k in VelColumns[6:]], axis=1)
+        self.sigma = None if np.all(np.isnan(s)) else SigmaFill(s, self.mask, fname)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return 'VelSet(%s, %d directions, %d velocities)'%(self.fname, len(self), self.mask.sum())
+
+    @property
+    def dens(self):
+        return self.meta.get('dens')
+
+    @property
+    def P(self):
+        return self.meta.get('P')
+
+    @property
+    def T(self):
+        return self.meta.get('T')
+
+    def data(self,dens=None):
+        from CijFit import VelData
+        dens = self.dens if dens is None else dens
+        if dens is None:
+            raise ValueError('no density given and none in the metadata of %s'%self.fname)
+        return VelData(self.n, self.vobs, dens, self.sigma)
+
+
+def SigmaFill(s,mask,fname):
+
+    # missing, nan or non-positive uncertainties take the median of the valid ones of their 
+    # column, so an observation is never silently given an arbitrary weight
+    s = s.copy()
+    for j in range(3):
+        ok = np.isfinite(s[:,j]) & (s[:,j] > 0)
+        if ok.all():
+            continue
+        if not ok.any():
+            if mask[:,j].any():
+                raise ValueError('%s: no valid uncertainty in column %s'%(fname, VelColumns[6+j]))
+            s[:,j] = 1.0
+            continue
+        s[~ok,j] = np.median(s[ok,j])
+    return s
+
+
+def ParseVel(fname):
+
+    # one pass over the text: metadata comments and the numeric rows
+    meta = {}
+    rows = []
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == '#':
+                line = line.lstrip('#').strip()
+                sep = '=' if '=' in line else ':' if ':' in line else None
+                if sep:
+                    k, v = [a.strip() for a in line.split(sep, 1)]
+                    try:
+                        v = float(v)
+                    except ValueError:
+                        pass
+                    meta[k] = v
+                continue
+            rows.append(line.split())
+    ncol = len(rows[0]) if rows else 6
+    if ncol not in (6, 9) or any(len(r) != ncol for r in rows):
+        raise ValueError('%s: expected 6 or 9 columns on every line'%fname)
+    d = np.array(rows, dtype=float).reshape(-1, ncol)
+    table = np.full(len(d), np.nan, dtype=VelDtype)
+    for j in range(ncol):
+        table[VelColumns[j]] = d[:,j]/1000.0 if j > 2 else d[:,j]
+    return table, meta
+
+
+def ReadVel(fname,cache=True):
+
+    st = os.stat(fname)
+    side = fname+'.npz'
+    if cache and os.path.exists(side):
+        try:
+            with np.load(side) as z:
+                if z['mtime'] == st.st_mtime_ns and z['size'] == st.st_size:
+                    return VelSet(fname, z['table'], json.loads(str(z['meta'])))
+        except Exception:
+            # truncated or corrupt sidecar (BadZipFile, EOFError, ...): parse the text again
+            pass
+    table, meta = ParseVel(fname)
+    if cache:
+        # write under a temporary name and move it into place, so a killed process never
+        # leaves a partial sidecar behind
+        tmp = side[:-4]+'.%d.tmp.npz' % os.getpid()
+        try:
+            np.savez(tmp, table=table, meta=json.dumps(meta), mtime=st.st_mtime_ns, size=st.st_size)
+            os.replace(tmp, side)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return VelSet(fname, table, meta)
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+def ReadDir(path,pattern='*.dat',cache=True):
+
+    return [ReadVel(f, cache) for f in sorted(glob.glob(os.path.join(path, pattern)))]
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo uncertainty propagation for aggregate moduli and anisotropy
+
+*********************************************************************************************
+
+###################
+#Function 1: CijMC#
+###################
+
+Draw nsamp samples of c1d, from the per-constant errors c1derr or from a full 21x21 covariance 
+cov (e.g. the fit covariance mapped through the symmetry class), and of density, and evaluate 
+Kv, Kr, Kvrh, Gv, Gr, Gvrh, Vp, Vs, the universal anisotropy index AU and optionally AVp, AVs 
+and DVs on the whole ensemble with the batched CijVRHBatch and CijtvelBatch. Unlike CijVRH and 
+UnivAniso this keeps all correlations between Cij, K, G and density.
+The samples are processed in chunks of chunk tensors to cap memory (for the anisotropy the 
+chunk is further reduced so that chunk x directions stays below 2e6 velocity solves). 
+Samples that are not Born-stable (c2r not positive definite) are rejected and counted.
+AVp, AVs and DVs are searched over the directions dirs (default CijDirs.DirGrid(300)), without 
+refinement; use a symmetry-reduced DirGrid to make this cheaper.
+
+Input: c1d and c1derr both as 1x21 1D array, density and density error, 
+	   optional nsamp (default 100000), cov (21x21), aniso (default False), dirs, chunk, 
+	   percentiles (default 2.5,16,50,84,97.5), seed, samples (default False)
+Output: dict with
+	names        the quantities evaluated
+	percentiles  the percentile levels
+	'<name>'     dict(mean, std, pct) for each quantity, pct at the percentile levels
+	nsamp, nrejected
+	samples      structured array of all accepted samples (only with samples=True)
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import numpy as np
+from CijSij124d import Cij1t2rBatch
+from CijKGvrh import CijVRHBatch
+from CijtVel import CijtvelBatch
+from CijDirs import DirGrid
+
+MCnames = ['Kv','Kr','Kvrh','Gv','Gr','Gvrh','Vp','Vs','AU']
+Anisonames = ['AVp','AVs','DVs']
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+def AnisoBatch(c1d,dens,dirs,Vpvrh,Vsvrh):
+
+    # AVp, AVs, DVs of a stack of tensors over a fixed set of directions
+    vel = CijtvelBatch(c1d, dirs, dens)[0]
+    AVp = (vel[:,:,0].max(1)-vel[:,:,0].min(1))/Vpvrh
+    AVs = (vel[:,:,1].max(1)-vel[:,:,2].min(1))/Vsvrh
+    DVs = (vel[:,:,1]-vel[:,:,2]).max(1)/Vsvrh
+    return AVp, AVs, DVs
+
+
+def CijMC(c1d,c1derr,dens,denserr,nsamp=100000,cov=None,aniso=False,dirs=None,chunk=20000,
+          percentiles=(2.5,16.0,50.0,84.0,97.5),seed=None,samples=False):
+
+    rng = np.random.default_rng(seed)
+    c1d = np.asarray(c1d, dtype=float)
+    if cov is None:
+        cov = np.diag(np.asarray(c1derr, dtype=float)**2)
+    # factor of the covariance; eigh copes with the zero rows of constants fixed by symmetry
+    w, U = np.linalg.eigh(np.asarray(cov, dtype=float))
+    L = U*np.maximum(w, 0.0)**0.5
+    names = MCnames+(Anisonames if aniso else [])
+    if aniso:
+        dirs = DirGrid(300) if dirs is None else np.asarray(dirs, dtype=float)
+        chunk = max(1, min(chunk, int(2e6//len(dirs))))
+    out = np.zeros(nsamp, dtype=[(k, float) for k in names])
+    nacc = 0
+    nrej = 0
+    done = 0
+    while done < nsamp:
+        k = min(chunk, nsamp-done)
+        done += k
+        C = c1d+rng.standard_normal((k,21)).dot(L.T)
+        D = dens+denserr*rng.standard_normal(k)
+        # Born stability: c2r positive definite; density positive
+        ok = (np.linalg.eigvalsh(Cij1t2rBatch(C))[:,0] > 0.0) & (D > 0.0)
+        nrej += k-ok.sum()
+        C = C[ok]
+        D = D[ok]
+        k = len(C)
+        if k == 0:
+            continue
+        res = CijVRHBatch(C, np.zeros((k,21)), D, 0.0)
+        blk = out[nacc:nacc+k]
+        for name in MCnames[:-1]:
+            blk[name] = res[name]
+        blk['AU'] = 5.0*res['Gv']/res['Gr']+res['Kv']/res['Kr']-6.0
+        if aniso:
+            blk['AVp'], blk['AVs'], blk['DVs'] = AnisoBatch(C, D, dirs, res['Vp'], res['Vs'])
+        nacc += k
+    out = out[:nacc]
+    result = dict(names=names, percentiles=np.array(percentiles), nsamp=nacc, nrejected=nrej)
+    for name in names:
+        x = out[name]
+        result[name] = dict(mean=x.mean(), std=x.std(ddof=1), pct=np.percentile(x, percentiles))
+    if samples:
+        result['samples'] = out
+    return result
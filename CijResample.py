@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Bootstrap and jackknife resampling of the measured directions of a velocity fit
+
+*********************************************************************************************
+
+#########################
+#Function 1: CijResample#
+#########################
+
+Refit a velocity dataset on resampled sets of its phonon directions to see how much the Cij 
+depend on which directions were measured:
+	method='bootstrap': nsamp sets of M directions drawn with replacement
+	method='jackknife': the M leave-one-direction-out sets
+The resampled datasets are taken from the prepared VelData of the fit (VelData.take), so no 
+file is parsed and no Christoffel basis is rebuilt. Every refit starts from the full-data 
+solution with the bounds of the original fit; the refits run in a process pool in chunks of 
+chunk sets. Kv, Kr, Kvrh, Gv, Gr, Gvrh, Vp, Vs, AU and optionally AVp, AVs and DVs are then 
+evaluated on all refitted tensors at once as in CijMC. Refits that fail are dropped and 
+counted. For the jackknife, std is the jackknife standard error 
+sqrt((M-1)/M*sum((x-mean)**2)) and bias the jackknife bias (M-1)*(mean-full).
+
+Input: FitResult of CijFit or CijFitData, optional method (default 'bootstrap'), nsamp 
+	   (default 1000), aniso, dirs, percentiles, seed, processes, chunk, samples and lmfit 
+	   keywords for the refits
+Output: dict as CijMC with the fitted constants added to names, and
+	method, nsamp, nfailed
+	'<name>'     dict(mean, std, pct, full) for each quantity (jackknife also bias)
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from CijFit import CijFitData, Sym
+from CijKGvrh import CijVRHBatch
+from CijMC import MCnames, Anisonames, AnisoBatch
+from CijDirs import DirGrid
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+def FitSets(data,sym,p0,pmin,pmax,sets,kws):
+
+    # worker: refit each resampled set of directions from the full-data solution
+    sym = Sym(sym)
+    vals = np.zeros((len(sets), len(p0)))
+    ok = np.zeros(len(sets), dtype=bool)
+    for i, rows in enumerate(sets):
+        try:
+            fit = CijFitData(data.take(rows), sym, p0, pmin, pmax, **kws)
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        vals[i] = fit.values
+        ok[i] = fit.result.success
+    return vals, ok
+
+
+def Derived(C,dens,aniso,dirs):
+
+    # aggregate moduli, velocities and anisotropy of a stack of c1d
+    k = len(C)
+    res = CijVRHBatch(C, np.zeros((k,21)), dens, 0.0)
+    out = dict((name, res[name]) for name in MCnames[:-1])
+    out['AU'] = 5.0*res['Gv']/res['Gr']+res['Kv']/res['Kr']-6.0
+    if aniso:
+        out['AVp'], out['AVs'], out['DVs'] = AnisoBatch(C, np.broadcast_to(dens, (k,)), dirs, 
+                                                        res['Vp'], res['Vs'])
+    return out
+
+
+def CijResample(fit,method='bootstrap',nsamp=1000,aniso=False,dirs=None,
+                percentiles=(2.5,16.0,50.0,84.0,97.5),seed=None,processes=None,chunk=50,
+                samples=False,**kws):
+
+    if fit.data is None:
+        raise ValueError('resampling needs the fitted VelData (fit.data)')
+    data = fit.data
+    sym = fit.sym
+    para = fit.result.params
+    pmin = np.array([para[k].min for k in sym.names])
+    pmax = np.array([para[k].max for k in sym.names])
+    M = len(data.n)
+    if method == 'bootstrap':
+        rng = np.random.default_rng(seed)
+        sets = rng.integers(0, M, (nsamp, M))
+    elif method == 'jackknife':
+        sets = np.array([np.delete(np.arange(M), i) for i in range(M)])
+    else:
+        raise ValueError("method must be 'bootstrap' or 'jackknife'")
+    processes = processes or os.cpu_count()
+    # at least one block per process
+    chunk = max(1, min(chunk, -(-len(sets)//processes)))
+    blocks = [sets[i:i+chunk] for i in range(0, len(sets), chunk)]
+    args = (data, sym, fit.values, pmin, pmax)
+    if processes == 1:
+        parts = [FitSets(*(args+(b, kws))) for b in blocks]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(FitSets, *(args+(b, kws))) for b in blocks]
+            parts = [f.result() for f in futures]
+    vals = np.vstack([v for v, ok in parts])
+    ok = np.concatenate([ok for v, ok in parts])
+    vals = vals[ok]
+    if aniso:
+        dirs = DirGrid(300) if dirs is None else np.asarray(dirs, dtype=float)
+    names = list(sym.names)+MCnames+(Anisonames if aniso else [])
+    out = np.zeros(len(vals), dtype=[(k, float) for k in names])
+    full = dict(zip(sym.names, fit.values))
+    full.update((k, v[0]) for k, v in Derived(fit.c1d[None,:], data.dens, aniso, dirs).items())
+    for j, k in enumerate(sym.names):
+        out[k] = vals[:,j]
+    if len(vals):
+        for k, v in Derived(vals.dot(sym.Map.T), data.dens, aniso, dirs).items():
+            out[k] = v
+    result = dict(names=names, percentiles=np.array(percentiles), method=method, 
+                  nsamp=len(vals), nfailed=len(sets)-len(vals))
+    n = len(vals)
+    for name in names:
+        x = out[name]
+        r = dict(mean=x.mean(), pct=np.percentile(x, percentiles), full=full[name])
+        if method == 'jackknife':
+            r['std'] = ((n-1.0)/n*((x-x.mean())**2).sum())**0.5
+            r['bias'] = (n-1.0)*(x.mean()-full[name])
+        else:
+            r['std'] = x.std(ddof=1)
+        result[name] = r
+    if samples:
+        result['samples'] = out
+    return result
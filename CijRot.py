@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Batched rotation of elastic tensors and orientation-averaged aggregates of textured 
+polycrystals
+
+*********************************************************************************************
+
+######################
+#Function 1: EulerRot#
+######################
+
+Rotation matrices from Bunge Euler angles (phi1, Phi, phi2; z-x-z), as used for EBSD data 
+and ODFs. Bunge angles give the matrix g that takes sample into crystal coordinates; EulerRot 
+returns R = g^T, which takes a crystal tensor into the sample frame.
+
+Input: euler as (N,3) array (or 3 angles), optional degrees (default True)
+Output: R as (N,3,3) array
+
+*********************************************************************************************
+
+########################
+#Function 2: BondMatrix#
+########################
+
+6x6 Bond matrices M of a stack of rotations, C' = M.C.M^T for a Cij in Voigt notation 
+(Auld, Acoustic Fields and Waves in Solids), built from precomputed flat index tables of 
+the products R_ik.R_jl. M(R)^-1 = M(R^T), so a compliance rotates as S' = N.S.N^T with 
+N = M(R^T)^T = D.M.D^-1, D = diag(1,1,1,2,2,2), without any 6x6 inversion.
+
+Input: R as (N,3,3) array
+Output: M as (N,6,6) array
+
+*********************************************************************************************
+
+#####################
+#Function 3: RotCij #
+#####################
+
+Rotate a stack of tensors: RotC2r for (N,6,6) Cij, RotC1d for (N,21) or a single c1d 
+rotated by every R. The rotated c1d goes straight into Cijtvel, CijtvelBatch or AVpVs.
+
+Input: c2r as (6,6) or (N,6,6) / c1d as (21,) or (N,21), R as (N,3,3)
+Output: rotated c2r as (N,6,6) / c1d as (N,21)
+
+*********************************************************************************************
+
+########################
+#Function 4: TextureVRH#
+########################
+
+Texture-weighted Voigt, Reuss and Hill aggregate tensors of a polycrystal:
+	Voigt  CV = sum(w*M.C.M^T)/sum(w)
+	Reuss  CR = inv(sum(w*S')/sum(w)), S' the rotated compliance
+	Hill   CH = (CV+CR)/2
+The orientations (Euler angles or rotation matrices, e.g. from an EBSD map or sampled from 
+an ODF) and the weights are streamed in chunks of chunk grains, so only the two 6x6 sums are 
+kept and memory stays bounded for maps of 1e7 points; np.memmap or np.load(mmap_mode='r') 
+arrays are read chunk by chunk. c1d is the single-crystal tensor of one phase, or one c1d 
+per grain (N,21) for multi-phase maps, converted and inverted one chunk at a time. For a 
+single phase the average is linear in C and only the 36x36 sum of w*M_ia*M_jb is 
+accumulated, one matrix product per chunk. For uniformly random orientations CV and CR are 
+isotropic with the Kv, Gv and Kr, Gr of CijVRH.
+
+Input: c1d as (21,) or (N,21), euler as (N,3) or R as (N,3,3), optional weights (N,), 
+	   chunk (default 100000), degrees
+Output: dict with the aggregate c1d of 'Voigt', 'Reuss', 'Hill' (each 1x21), and 'weight' 
+		the total weight
+
+*********************************************************************************************
+
+########################
+#Function 5: RotC1dGrad#
+########################
+
+Derivatives of a rotated c1d, for fitting orientations (CijFit.CijFitPlatelets). 
+EulerRotGrad gives dR/d(phi1, Phi, phi2); BondPair(A,B) is the Bond product bilinear in 
+two matrices (BondMatrix(R) = BondPair(R,R)), so dM = BondPair(dR,R)+BondPair(R,dR). 
+RotC1dGrad returns the rotated c1d with its derivatives with respect to the unrotated c1d 
+(the linear map T, c1d' = T.c1d) and to the three Euler angles.
+
+Input: c1d as (21,), euler as (N,3), optional degrees (derivatives per degree if True)
+Output: c1d' as (N,21), T as (N,21,21), dc1d'/deuler as (N,21,3)
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import numpy as np
+from CijSij124d import Cij1t2rBatch, VoigtRow, VoigtCol, C2rIdx
+
+# index pair (i,j) of each Voigt index: 11, 22, 33, 23, 13, 12
+VoigtI = np.array([0,1,2,1,0,0])
+VoigtJ = np.array([0,1,2,2,2,1])
+
+# flat (3x3) indices of the products in the Bond matrix, row-major over (I,J):
+# M_IJ = R_ik R_jl + R_il R_jk for the shear columns (k != l), R_ik R_jl otherwise
+BondIK = (3*VoigtI[:,None]+VoigtI[None,:]).ravel()
+BondJL = (3*VoigtJ[:,None]+VoigtJ[None,:]).ravel()
+BondShear = np.flatnonzero(np.broadcast_to(VoigtI[None,:] != VoigtJ[None,:], (6,6)))
+BondIL = (3*VoigtI[:,None]+VoigtJ[None,:]).ravel()[BondShear]
+BondJK = (3*VoigtJ[:,None]+VoigtI[None,:]).ravel()[BondShear]
+
+# the compliance Bond matrix M(R^T)^T = D.M(R).D^-1, D = diag(1,1,1,2,2,2)
+BondS = np.array([1,1,1,2,2,2.])[:,None]/np.array([1,1,1,2,2,2.])[None,:]
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+def EulerRot(euler,degrees=True):
+
+    euler = np.atleast_2d(np.asarray(euler, dtype=float))
+    if degrees:
+        euler = np.radians(euler)
+    c1, C, c2 = np.cos(euler).T
+    s1, S, s2 = np.sin(euler).T
+    g = np.empty((len(euler),3,3))
+    g[:,0,0] = c1*c2-s1*s2*C
+    g[:,0,1] = s1*c2+c1*s2*C
+    g[:,0,2] = s2*S
+    g[:,1,0] = -c1*s2-s1*c2*C
+    g[:,1,1] = -s1*s2+c1*c2*C
+    g[:,1,2] = c2*S
+    g[:,2,0] = s1*S
+    g[:,2,1] = -c1*S
+    g[:,2,2] = C
+    return np.swapaxes(g, -1, -2)
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+def BondMatrix(R):
+
+    return BondPair(R, R)
+
+
+def BondPair(A,B):
+
+    A = np.asarray(A, dtype=float)
+    B = np.asarray(B, dtype=float)
+    A9 = A.reshape(A.shape[:-2]+(9,))
+    B9 = B.reshape(B.shape[:-2]+(9,))
+    M = A9[...,BondIK]*B9[...,BondJL]
+    M[...,BondShear] += A9[...,BondIL]*B9[...,BondJK]
+    return M.reshape(A.shape[:-2]+(6,6))
+
+########################################################
+######################Function 3: ######################
+########################################################
+
+def RotC2r(c2r,R):
+
+    M = BondMatrix(R)
+    return M @ np.asarray(c2r, dtype=float) @ np.swapaxes(M, -1, -2)
+
+
+def RotC1d(c1d,R):
+
+    return RotC2r(Cij1t2rBatch(c1d), R)[...,VoigtRow,VoigtCol]
+
+########################################################
+######################Function 4: ######################
+########################################################
+
+def TextureVRH(c1d,euler=None,R=None,weights=None,chunk=100000,degrees=True):
+
+    if (euler is None) == (R is None):
+        raise ValueError('give either euler or R')
+    N = len(euler) if R is None else len(R)
+    # one phase: convert once; per-grain c1d (maybe a memmap) is converted chunk by chunk
+    single = np.ndim(c1d) == 1
+    if single:
+        c2r = Cij1t2rBatch(np.asarray(c1d, dtype=float))
+        s2r = np.linalg.inv(c2r)
+    CV = np.zeros((6,6))
+    SR = np.zeros((6,6))
+    QV = np.zeros((36,36))
+    QR = np.zeros((36,36))
+    wsum = 0.0
+    for a in range(0, N, chunk):
+        b = min(a+chunk, N)
+        Rc = EulerRot(euler[a:b], degrees) if R is None else np.asarray(R[a:b], dtype=float)
+        w = np.ones(b-a) if weights is None else np.asarray(weights[a:b], dtype=float)
+        M = BondMatrix(Rc)
+        Mt = M*BondS
+        if single:
+            # one phase: the average is linear in C, so only sum(w*M_ia*M_jb) is needed,
+            # a single (36,N).(N,36) product per chunk
+            QV += (w[:,None]*M.reshape(-1,36)).T.dot(M.reshape(-1,36))
+            QR += (w[:,None]*Mt.reshape(-1,36)).T.dot(Mt.reshape(-1,36))
+        else:
+            Cc = Cij1t2rBatch(np.asarray(c1d[a:b], dtype=float))
+            Sc = np.linalg.inv(Cc)
+            CV += np.einsum('n,nij->ij', w, M @ Cc @ np.swapaxes(M, -1, -2))
+            SR += np.einsum('n,nij->ij', w, Mt @ Sc @ np.swapaxes(Mt, -1, -2))
+        wsum += w.sum()
+    if single:
+        CV = np.einsum('iajb,ab->ij', QV.reshape(6,6,6,6), c2r)
+        SR = np.einsum('iajb,ab->ij', QR.reshape(6,6,6,6), s2r)
+    CV /= wsum
+    CR = np.linalg.inv(SR/wsum)
+    CH = (CV+CR)/2.0
+    return {'Voigt':CV[VoigtRow,VoigtCol], 'Reuss':CR[VoigtRow,VoigtCol], 
+            'Hill':CH[VoigtRow,VoigtCol], 'weight':wsum}
+
+########################################################
+######################Function 5: ######################
+########################################################
+
+def EulerRotGrad(euler,degrees=True):
+
+    euler = np.atleast_2d(np.asarray(euler, dtype=float))
+    a = np.radians(euler) if degrees else euler
+    c, s = np.cos(a), np.sin(a)
+    N = len(a)
+    # passive rotations g = Z(phi2).X(Phi).Z(phi1) and their derivatives
+    Z1, X, Z2 = np.zeros((N,3,3)), np.zeros((N,3,3)), np.zeros((N,3,3))
+    dZ1, dX, dZ2 = np.zeros((N,3,3)), np.zeros((N,3,3)), np.zeros((N,3,3))
+    for Z, dZ, k in ((Z1, dZ1, 0), (Z2, dZ2, 2)):
+        Z[:,0,0] = Z[:,1,1] = c[:,k]
+        Z[:,0,1] = s[:,k]
+        Z[:,1,0] = -s[:,k]
+        Z[:,2,2] = 1.0
+        dZ[:,0,0] = dZ[:,1,1] = -s[:,k]
+        dZ[:,0,1] = c[:,k]
+        dZ[:,1,0] = -c[:,k]
+    X[:,1,1] = X[:,2,2] = c[:,1]
+    X[:,1,2] = s[:,1]
+    X[:,2,1] = -s[:,1]
+    X[:,0,0] = 1.0
+    dX[:,1,1] = dX[:,2,2] = -s[:,1]
+    dX[:,1,2] = c[:,1]
+    dX[:,2,1] = -c[:,1]
+    dg = np.stack((Z2 @ X @ dZ1, Z2 @ dX @ Z1, dZ2 @ X @ Z1), axis=-1)
+    if degrees:
+        dg *= np.pi/180.0
+    # R = g^T
+    return np.swapaxes(dg, 1, 2)
+
+
+def RotC1dGrad(c1d,euler,degrees=True):
+
+    R = EulerRot(euler, degrees)
+    dR = EulerRotGrad(euler, degrees)
+    M = BondMatrix(R)
+    c2r = Cij1t2rBatch(np.asarray(c1d, dtype=float))
+    c1dr = (M @ c2r @ np.swapaxes(M, -1, -2))[...,VoigtRow,VoigtCol]
+    # T[q,r] = sum over C2rIdx[a,b] == r of M[row q,a]*M[col q,b]
+    MM = M[:,VoigtRow,:,None]*M[:,VoigtCol,None,:]
+    T = np.zeros((len(R),21,21))
+    np.add.at(T, (slice(None), slice(None), C2rIdx.ravel()), MM.reshape(len(R),21,36))
+    dc = np.zeros((len(R),21,3))
+    for k in range(3):
+        dM = BondPair(dR[...,k], R)+BondPair(R, dR[...,k])
+        d2r = dM @ c2r @ np.swapaxes(M, -1, -2)
+        dc[:,:,k] = (d2r+np.swapaxes(d2r, -1, -2))[...,VoigtRow,VoigtCol]
+    return c1dr, T, dc
+
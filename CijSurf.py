@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of velocity surfaces to memory-mapped arrays for pole figures
+
+*********************************************************************************************
+
+#########################
+#Function 1: VelSurfIter#
+#########################
+
+Evaluate the velocity surface of one tensor chunk by chunk: Vp, Vs1, Vs2, their 
+polarizations, the shear-wave splitting dVs = Vs1-Vs2 and AVs = 200*(Vs1-Vs2)/(Vs1+Vs2) (%), 
+with CijtvelBatch on chunk directions at a time. The directions are either given (dirs, any 
+(M,3) array incl. np.memmap) or the Fibonacci lattice of npts points, generated slice by 
+slice (CijDirs.FibSphere with start, stop), over the upper hemisphere only with 
+hemisphere=True (velocities are centrosymmetric, V(n) = V(-n)).
+
+Input: c1d as 1x21, density, dirs or npts, optional chunk (default 200000), hemisphere
+Output: generator of dicts with start (index of the first direction), n (k,3), vel (k,3), 
+		pol (k,3,3) as CijtvelBatch, dVs (k,), AVs (k,)
+
+*********************************************************************************************
+
+###########################
+#Function 2: ExportVelSurf#
+###########################
+
+Stream VelSurfIter straight into memory-mapped .npy files in the directory path: n.npy, 
+vel.npy, pol.npy, dVs.npy, AVs.npy, so a surface of any size never has to fit in RAM. 
+index.json (c1d, dens, number of directions, fields with their shapes and dtype) is written 
+last and marks a complete export. dtype defaults to float32 (half the size; velocities to 
+~1e-6 km/s).
+
+Input: c1d as 1x21, density, path, dirs or npts, optional chunk, hemisphere, dtype
+Output: path; the arrays are on disk
+
+*********************************************************************************************
+
+#########################
+#Function 3: ReadVelSurf#
+#########################
+
+Open an exported surface without reading it: the fields are np.load(mmap_mode='r') arrays, 
+so slicing reads only what is used. VelSurf.pole(field, step, proj) gives the x, y of the 
+lower or upper hemisphere projection (proj 'equal-area' (Schmidt) or 'stereographic' (Wulff), 
+unit circle) and the values of the field for every step-th direction, ready for a 
+scatter/tricontour pole figure; PoleXY does the projection for any directions.
+
+Input: path, optional mmap (default True)
+Output: VelSurf with index (dict), the fields as attributes (n, vel, pol, dVs, AVs), 
+		fields, len and pole()
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import os
+import json
+import numpy as np
+from CijtVel import CijtvelBatch
+from CijDirs import FibSphere
+
+SurfFields = {'n':(3,), 'vel':(3,), 'pol':(3,3), 'dVs':(), 'AVs':()}
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+def VelSurfIter(c1d,dens,dirs=None,npts=None,chunk=200000,hemisphere=False):
+
+    if (dirs is None) == (npts is None):
+        raise ValueError('give either dirs or npts')
+    M = len(dirs) if dirs is not None else npts
+    for a in range(0, M, chunk):
+        b = min(a+chunk, M)
+        if dirs is not None:
+            n = np.asarray(dirs[a:b], dtype=float)
+        else:
+            # the first npts points of a 2*npts lattice are the upper hemisphere
+            n = FibSphere(2*npts if hemisphere else npts, a, b)
+        vel, pol = CijtvelBatch(c1d, n, dens)
+        dVs = vel[:,1]-vel[:,2]
+        yield dict(start=a, n=n, vel=vel, pol=pol, dVs=dVs, AVs=200.0*dVs/(vel[:,1]+vel[:,2]))
+
+########################################################
+######################Function 2: ######################
+########################################################
+
+def ExportVelSurf(c1d,dens,path,dirs=None,npts=None,chunk=200000,hemisphere=False,dtype='f4'):
+
+    M = len(dirs) if dirs is not None else npts
+    os.makedirs(path, exist_ok=True)
+    index = os.path.join(path, 'index.json')
+    if os.path.exists(index):
+        os.remove(index)
+    out = {}
+    for k, shape in SurfFields.items():
+        out[k] = np.lib.format.open_memmap(os.path.join(path, k+'.npy'), mode='w+', 
+                                           dtype=dtype, shape=(M,)+shape)
+    for blk in VelSurfIter(c1d, dens, dirs, npts, chunk, hemisphere):
+        a = blk['start']
+        for k in SurfFields:
+            out[k][a:a+len(blk['n'])] = blk[k]
+    for k in SurfFields:
+        out[k].flush()
+    del out
+    info = dict(c1d=[float(c) for c in np.asarray(c1d, dtype=float)], dens=float(dens), npts=int(M),
+                hemisphere=bool(hemisphere), dtype=np.dtype(dtype).str,
+                fields=dict((k, [M]+list(shape)) for k, shape in SurfFields.items()))
+    with open(index, 'w') as f:
+        json.dump(info, f, indent=1)
+    return path
+
+########################################################
+######################Function 3: ######################
+########################################################
+
+def PoleXY(n,proj='equal-area',upper=False):
+
+    n = np.asarray(n, dtype=float)
+    n = n/np.linalg.norm(n, axis=-1)[...,None]
+    # fold onto the projected hemisphere, V(n) = V(-n)
+    z = n[...,2] if upper else -n[...,2]
+    n = np.where((z < 0)[...,None], -n, n)
+    z = np.abs(z)
+    if proj == 'equal-area':
+        r = (1.0-z)**0.5
+    elif proj == 'stereographic':
+        r = np.tan(np.arccos(np.clip(z, -1.0, 1.0))/2.0)
+    else:
+        raise ValueError("proj must be 'equal-area' or 'stereographic'")
+    rho = np.hypot(n[...,0], n[...,1])
+    s = np.divide(r, rho, out=np.zeros_like(r), where=rho > 0)
+    return n[...,0]*s, n[...,1]*s
+
+
+class VelSurf(object):
+
+    def __init__(self,path,mmap=True):
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.path = path
+        self.fields = list(self.index['fields'])
+        for k in self.fields:
+            setattr(self, k, np.load(os.path.join(path, k+'.npy'), mmap_mode='r' if mmap else None))
+
+    def __len__(self):
+        return self.index['npts']
+
+    def __repr__(self):
+        return 'VelSurf(%s, %d directions)'%(self.path, len(self))
+
+    def pole(self,field,step=1,proj='equal-area',upper=False):
+        x, y = PoleXY(self.n[::step], proj, upper)
+        return x, y, np.asarray(getattr(self, field)[::step])
+
+
+def ReadVelSurf(path,mmap=True):
+
+    return VelSurf(path, mmap)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Single-crystal elasticity tensor with lazily cached derived quantities
+
+*********************************************************************************************
+
+###########################
+#Function 1: ElasticTensor#
+###########################
+
+Holds c1d (1x21 1D array in the sequence of CijSij124d) and density. The derived quantities 
+are computed on first use and then kept:
+	c2r     Cij as 6x6 array (Cij1t2r)
+	s2r     Sij as 6x6 array, the only 6x6 inversion
+	c4r     Cijkl as 3x3x3x3 array, the only 4D expansion
+	kbasis  c4r rearranged as a 9x9 array, A(n).ravel() = kbasis.dot(outer(n,n).ravel()), 
+	        used by CijtvelBatch and CijtvelGrad for the Christoffel matrices
+	vrh     CijVRH result (2x9 array) without errors, returned by CijVRH (and so used by 
+	        AVpVs and UnivAniso) when it is called with zero errors and the same density
+The cached arrays are read-only, and c1d and dens cannot be changed after construction (make a 
+new ElasticTensor instead), so the cache never goes stale.
+
+The existing functions accept an ElasticTensor wherever they take c1d, e.g. 
+Cijtvel(et, n, et.dens), CijVRH(et, c1derr, et.dens, denserr), UnivAniso, AVpVs(et, et.dens, m): 
+the conversions in CijSij124d return the cached c2r, c4r and s2r, and np.asarray(et) gives c1d.
+
+Input: c1d as 1x21 1D array, density
+Output: ElasticTensor
+
+*********************************************************************************************
+
+Redistribution and use in source and binary forms, with or without modification, are permitted 
+provided that the following conditions are met:
+
+ * Redistributions of source code must retain the above copyright notice, this list of 
+   conditions and the following disclaimer.
+ * Redistributions in binary form must reproduce the above copyright notice, this list of 
+   conditions and the following disclaimer in the documentation and/or other materials 
+   provided with the distribution.
+ * Neither the name of the copyright holders nor the names of any contributors may be used 
+   to endorse or promote products derived from this software without specific prior written 
+   permission.
+
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS 
+ OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+ MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE
+ COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) 
+ HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+ (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+ IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Copyright (c) 2016-2023, @author: Jin Zhang, Department of Geology and Geophysics, Texas A&M University
+All rights reserved.
+
+"""
+import numpy as np
+from CijSij124d import Cij1t2rBatch, C1dt4rBatch
+from CijKGvrh import CijVRHBatch, VRHnames
+
+########################################################
+######################Function 1: ######################
+########################################################
+
+class ElasticTensor(object):
+
+    __slots__ = ('_c1d', '_dens', '_c2r', '_s2r', '_c4r', '_kbasis', '_vrh')
+
+    def __init__(self,c1d,dens):
+        c1d = np.array(c1d, dtype=float).reshape(21)
+        c1d.setflags(write=False)
+        self._c1d = c1d
+        self._dens = float(dens)
+        self._c2r = self._s2r = self._c4r = self._kbasis = self._vrh = None
+
+    def __array__(self,dtype=None,copy=None):
+        return self._c1d if dtype is None else self._c1d.astype(dtype)
+
+    def __len__(self):
+        return 21
+
+    def __getitem__(self,i):
+        return self._c1d[i]
+
+    def __repr__(self):
+        return 'ElasticTensor(%s, dens=%g)' % (np.array2string(self._c1d, precision=2, separator=','), self._dens)
+
+    @property
+    def c1d(self):
+        return self._c1d
+
+    @property
+    def dens(self):
+        return self._dens
+
+    @property
+    def c2r(self):
+        if self._c2r is None:
+            self._c2r = Cij1t2rBatch(self._c1d)
+            self._c2r.setflags(write=False)
+        return self._c2r
+
+    @property
+    def s2r(self):
+        if self._s2r is None:
+            self._s2r = np.linalg.inv(self.c2r)
+            self._s2r.setflags(write=False)
+        return self._s2r
+
+    @property
+    def c4r(self):
+        if self._c4r is None:
+            self._c4r = C1dt4rBatch(self._c1d)
+            self._c4r.setflags(write=False)
+        return self._c4r
+
+    @property
+    def kbasis(self):
+        if self._kbasis is None:
+            self._kbasis = np.ascontiguousarray(self.c4r.transpose(0,2,1,3)).reshape(9,9)
+            self._kbasis.setflags(write=False)
+        return self._kbasis
+
+    @property
+    def vrh(self):
+        if self._vrh is None:
+            # CijVRHBatch directly: CijVRH itself returns this cached array
+            res = CijVRHBatch(self, np.zeros((1,21)), self._dens, 0.0)[0]
+            self._vrh = np.array([[res[k] for k in VRHnames], [res[k+'err'] for k in VRHnames]])
+            self._vrh.setflags(write=False)
+        return self._vrh
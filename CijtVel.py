@@ -44,6 +44,131 @@ Output: c4r as 4D array
 
 *********************************************************************************************
 
+##########################
+#Function 4: CijtvelBatch#
+##########################
+
+Calculate velocities for many phonon directions, and optionally many Cij models, in one call.
+c4r is built once and rearranged as a 9x9 kernel, the Christoffel matrices of all directions 
+are assembled in one matrix product and solved with the batched symmetric eigensolver. For 
+an ElasticTensor (CijTensor) the kernel is its cached kbasis.
+
+Input: Cijs: c1d as 1D array, or (N,21) array for a stack of N Cij models
+	   Phonon directions: n as (M,3) array
+	   density: dens as scalar number, or (N,) array
+Output: Velocities: vel as (M,3) array, or (N,M,3), in the sequence of Vp-Vs1-Vs2
+	    Polarization directions: pol as (M,3,3) array, or (N,M,3,3); pol[m,0] for Vp, 
+								 pol[m,1] for Vs1, pol[m,2] for Vs2 along direction n[m]
+
+*********************************************************************************************
+
+#########################
+#Function 5: CijtvelGrad#
+#########################
+
+Same as CijtvelBatch, and in addition the analytic gradient of each velocity with respect to 
+the phonon direction, from the eigenvectors of the same solve (no extra eigen-decomposition):
+dV/dn_m = Cimkl*pi*pk*nl/(dens*V)
+
+Input: same as CijtvelBatch
+Output: vel, pol as CijtvelBatch; grad as (M,3,3) array, or (N,M,3,3), grad[m,k] is the 
+		gradient of vel[m,k] with respect to n[m]
+
+*********************************************************************************************
+
+########################
+#Function 6: CijtvelJac#
+########################
+
+Same as CijtvelBatch, and in addition the analytic Jacobian of the velocities with respect to 
+the 21 elastic constants of c1d, from the polarization and phonon directions of the same solve:
+dE/dCijkl = pi*nj*pk*nl, summed over all ijkl that map to the same c1d element, and 
+dV/dc1d = dE/dc1d/(2*dens*V). dV/ddens = -V/(2*dens).
+Used as the analytic Jacobian (Dfun) of velocity fits. For degenerate shear waves the 
+derivative follows the eigenvectors returned by the solver.
+
+Input: same as CijtvelBatch
+Output: vel, pol as CijtvelBatch; jac as (M,3,21) array, or (N,M,3,21), jac[m,k,q] is the 
+		derivative of vel[m,k] with respect to c1d[q]
+
+*********************************************************************************************
+
+##############################
+#Function 7: ChristoffelBasis#
+##############################
+
+The Christoffel matrix is linear in the 21 constants of c1d: A[m] = basis[m].dot(c1d). 
+ChristoffelBasis computes, once for a fixed set of directions, the (M,3,3,21) basis 
+basis[m,i,k,q] = sum of nj*nl over the Cijkl that map to c1d[q], so that the Christoffel 
+matrices of all directions for any c1d are a single tensor contraction.
+
+Input: Phonon directions: n as (M,3) array
+Output: basis as (M,3,3,21) array
+
+*********************************************************************************************
+
+####################
+#Function 8: Eigsh3#
+####################
+
+Closed-form eigen-solver for stacks of 3x3 symmetric matrices such as Christoffel matrices, 
+used by CijtvelBatch, CijtvelGrad and the fitting forward model in place of numpy.linalg.eigh.
+The eigenvalues come from the trigonometric (Cardano) solution of the characteristic cubic. 
+The eigenvector of the best separated eigenvalue is the largest cross product of two rows of 
+A-lambda*I; the other two eigenpairs are the exact solution of the remaining 2x2 problem in 
+the plane normal to it. Near (or at) a double eigenvalue, common along the symmetry axes of 
+cubic crystals, this still returns an orthonormal basis of the degenerate subspace, and a 
+triple eigenvalue (isotropic A) returns the identity.
+The matrices are solved in blocks of block (default 4096) by Eigsh3Block, so the elementwise 
+temporaries stay in cache; every step is a numpy pass over the block, without per-element 
+branches. On one core this solves about 2 million Christoffel matrices per second (CijtvelBatch 
+about 1.3 million directions per second), the lower end of the 10^6-10^7 range; more would 
+need a compiled kernel.
+
+Input: A as (...,3,3) array, optional block
+Output: E as (...,3) eigenvalues in ascending order, V as (...,3,3) eigenvectors in the 
+		columns, the same as numpy.linalg.eigh
+
+*********************************************************************************************
+
+########################
+#Function 9: CijtvelCov#
+########################
+
+Velocities along the phonon directions n with exact first-order errors from the full 21x21 
+covariance of c1d and the density error, using the analytic Jacobian of CijtvelJac.
+
+Input: c1d as 1x21 1D array, cov as 21x21 array, n as (M,3) array, density, density error
+Output: vel as (M,3) array, velerr as (M,3) array, velcov as (M,3,3) covariance of 
+		Vp, Vs1, Vs2 along each direction
+
+*********************************************************************************************
+
+##########################
+#Function 10: CijtvelGroup#
+##########################
+
+Group velocities, power-flow angles and phonon enhancement (focusing) factors, all from the 
+eigenvectors of the same Christoffel solve as the phase velocities (no extra eigen-
+decomposition, no finite differences):
+	group velocity   vg = dV/dn = Cimkl*pi*pk*nl/(dens*V), the gradient of CijtvelGrad
+	power-flow angle psi = arccos(V/|vg|), angle between vg and n (degrees)
+	enhancement      A = 1/(|s|^3*|vg|*|K|), K the Gaussian curvature of the slowness 
+	                 surface at s = n/V (A = 1 for an isotropic solid)
+K needs the Hessian of each eigenvalue E(n), from second-order perturbation theory on the 
+same eigenvectors: d2E/dna dnb = 2*Ciakb*pi*pk + 2*sum_j (p.dGa.pj)(pj.dGb.p)/(E-Ej). 
+Where two modes are degenerate (E-Ej < degtol*E, e.g. the shear acoustic axes) the curvature 
+is undefined and A is nan. The Cijkl, unit directions and contraction of the gradient are 
+shared with the Hessian. With enhance=False only vg and psi are computed, at about 1.4x the 
+cost of CijtvelBatch; with the enhancement factor about 2.3x (1e5 directions).
+
+Input: c1d as 1x21 1D array (or (N,21) stack as CijtvelBatch), n as (M,3) array, density, 
+	   optional enhance (default True), degtol (default 1e-8)
+Output: dict with vel, pol as CijtvelBatch, vg as (M,3,3) (vg[m,k] the group velocity vector 
+		of mode k), gv as (M,3) group speed, psi as (M,3) and A as (M,3)
+
+*********************************************************************************************
+
 Redistribution and use in source and binary forms, with or without modification, are permitted 
 provided that the following conditions are met:
 
@@ -73,9 +198,12 @@ All rights reserved.
 import numpy as np
 from numpy import linalg 
 import math
-from CijSij124d import Cij1t2r, Cij2t4r
+from CijSij124d import C1dt4rBatch, C4rIdx
 #from Rotation import rotation_matrix
 
+# (81,21) map from the flattened Cijkl to the c1d element each entry is taken from
+C4rOneHot = (C4rIdx.reshape(81,1) == np.arange(21)).astype(float)
+
 
 ########################################################
 ######################Function 1: ######################
@@ -83,30 +211,9 @@ from CijSij124d import Cij1t2r, Cij2t4r
 
 def Cijtvel(c1d,n,dens):
 
-	# Converting C1d to C4r
-    c2r = Cij1t2r(c1d)
-    c4r = Cij2t4r(c2r)
-	# Normalize the phonon direction
-    n = n/linalg.norm(n)
-    # Calculate the Christofol matrix: Cijkl*nj*nl
-    A = np.zeros((3,3))
-    for j in range (1,4):
-        for l in range (1,4):
-            for i in range (1,4): 
-                for k in range (1,4):
-                    A[i-1,k-1] += c4r[i-1,j-1,k-1,l-1]*n[j-1]*n[l-1]
-    #print 'Christfol matrix is:', '\n', A
-	
-    # Solve the eigenvector and eigen value of Christfol matrix A, E is the psudo-elastic-moduli E = Vel**2 * dens
-    E, pol = linalg.eig(A)
-    # Calculate velocity 
-    vel = (E/dens)**0.5
-    # Sort the velocities and obtain the sorting index i for the velocities in sequence of Vs1 < Vs2 < Vp, 
-    i = np.argsort(vel)
-	# Output the velocities and pol in sequence of Vp, Vs1>Vs2
-    vel = np.array([vel[i[2]],vel[i[1]],vel[i[0]]])
-    pol = np.array([pol[:,i[2]],pol[:,i[1]],pol[:,i[0]]])
-	
+    vel, pol = CijtvelBatch(c1d, np.reshape(n,(1,3)), dens)
+    vel, pol = vel[0], pol[0]
+
     # find which shear wave is Vsh, and which is Vsv, re-order the sequence of velocity array and polarization direction array in the sequence of Vp,Vsv,Vsh
     
 #	M = rotation_matrix(math.pi/2,pol[:,i[2]]) #clockwise rotation matrix with Vp's polarization direction
@@ -119,5 +226,263 @@ def Cijtvel(c1d,n,dens):
 #            vel = np.array([vel[i[2]],vel[i[0]],vel[i[1]]]) #pol[:,0] is Vsv
 #            pol = np.array([pol[:,i[2]],pol[:,i[0]],pol[:,i[1]]]) 
 #        else:
-#            print 'calculation error! The norms of the polarization directions are not 1!'		
-    return vel, pol
\ No newline at end of file
+#            print 'calculation error! The norms of the polarization directions are not 1!'
+    return vel, pol
+
+########################################################
+######################Function 4: ######################
+########################################################
+
+def Christoffel(c4r,n):
+
+    # Christofol matrix Cijkl*nj*nl for every direction in n; c4r may carry leading stack axes.
+    # c4r rearranged as the 9x9 kernel of ChristoffelK, so this is one matrix product
+    kbasis = np.swapaxes(c4r, -3, -2).reshape(c4r.shape[:-4]+(9,9))
+    nn = (n[:,:,None]*n[:,None,:]).reshape(-1,9)
+    A = np.matmul(nn, np.swapaxes(kbasis, -1, -2))
+    return A.reshape(A.shape[:-1]+(3,3))
+
+def ChristoffelK(kbasis,n):
+
+    # the same from the 9x9 kernel of an ElasticTensor: one (M,9).(9,9) product
+    nn = (n[:,:,None]*n[:,None,:]).reshape(-1,9)
+    return nn.dot(kbasis.T).reshape(-1,3,3)
+
+def CijtvelBatch(c1d,n,dens):
+
+    # Converting C1d to C4r, once for all directions
+    c4r = C1dt4rBatch(c1d)
+    # Normalize the phonon directions
+    n = np.atleast_2d(np.asarray(n, dtype=float))
+    n = n/linalg.norm(n, axis=1)[:,None]
+    A = ChristoffelK(c1d.kbasis, n) if hasattr(c1d, 'kbasis') else Christoffel(c4r, n)
+    # Eigsh3 returns the eigenvalues in ascending order, E = Vel**2 * dens
+    E, pol = Eigsh3(A)
+    dens = np.asarray(dens, dtype=float)[...,None,None]
+    # Output the velocities and pol in sequence of Vp, Vs1>Vs2
+    vel = (E[...,::-1]/dens)**0.5
+    pol = np.swapaxes(pol[...,::-1],-1,-2)
+    return vel, pol
+
+########################################################
+######################Function 5: ######################
+########################################################
+
+def CijtvelGrad(c1d,n,dens):
+
+    return GradSolve(c1d, n, dens)[:3]
+
+
+def GradSolve(c1d,n,dens):
+
+    # CijtvelGrad plus the Cijkl, unit directions and PolGrad contraction it was built from, 
+    # for reuse by CijtvelGroup
+    c4r = C1dt4rBatch(c1d)
+    n = np.atleast_2d(np.asarray(n, dtype=float))
+    n = n/linalg.norm(n, axis=1)[:,None]
+    A = ChristoffelK(c1d.kbasis, n) if hasattr(c1d, 'kbasis') else Christoffel(c4r, n)
+    E, pol = Eigsh3(A)
+    dens = np.asarray(dens, dtype=float)[...,None,None]
+    vel = (E[...,::-1]/dens)**0.5
+    pol = np.swapaxes(pol[...,::-1],-1,-2)
+    # dE/dn_m = 2*Cimkl*pi*pk*nl for unit pol, and dV/dn = dE/dn/(2*dens*V)
+    Y = PolGrad(c4r, n, pol)
+    grad = np.diagonal(Y, axis1=-3, axis2=-1)
+    grad = np.swapaxes(grad, -1, -2)/(dens*vel)[...,None]
+    return vel, pol, grad, c4r, n, Y
+
+
+def PolGrad(c4r,n,pol):
+
+    # Y[s,m,t] = pol_s.i Cimkl nl pol_t.k for each direction, as batched matrix products
+    W = np.matmul(n, np.swapaxes(c4r.reshape(c4r.shape[:-4]+(27,3)), -1, -2))
+    X = np.matmul(pol, W.reshape(W.shape[:-1]+(3,9)))
+    Y = np.matmul(X.reshape(X.shape[:-1]+(3,3)), np.swapaxes(pol, -1, -2)[...,None,:,:])
+    return Y
+
+########################################################
+######################Function 6: ######################
+########################################################
+
+def CijtvelJac(c1d,n,dens):
+
+    vel, pol = CijtvelBatch(c1d, n, dens)
+    n = np.atleast_2d(np.asarray(n, dtype=float))
+    n = n/linalg.norm(n, axis=1)[:,None]
+    # pi*nj for every mode, then pi*nj*pk*nl flattened over ijkl
+    pn = pol[...,:,None]*n[:,None,None,:]
+    pnpn = (pn[...,:,:,None,None]*pn[...,None,None,:,:]).reshape(pn.shape[:-2]+(81,))
+    dens = np.asarray(dens, dtype=float)[...,None,None]
+    jac = (pnpn @ C4rOneHot)/(2.0*dens*vel)[...,None]
+    return vel, pol, jac
+
+########################################################
+######################Function 7: ######################
+########################################################
+
+def ChristoffelBasis(n):
+
+    n = np.atleast_2d(np.asarray(n, dtype=float))
+    n = n/linalg.norm(n, axis=1)[:,None]
+    nn = n[:,:,None]*n[:,None,:]
+    return np.einsum('mjl,ijklq->mikq', nn, C4rOneHot.reshape(3,3,3,3,21))
+
+########################################################
+######################Function 8: ######################
+########################################################
+
+def Eigsh3(A,block=4096):
+
+    A = np.asarray(A, dtype=float)
+    # the nine elements of each matrix as rows, solved in blocks that stay in cache
+    a = A.reshape(-1,9).T
+    E = np.empty((a.shape[1],3))
+    V = np.empty((a.shape[1],3,3))
+    Eb = np.empty((3,block))
+    Vb = np.empty((3,3,block))
+    for s in range(0, a.shape[1], block):
+        m = min(block, a.shape[1]-s)
+        Eigsh3Block(np.ascontiguousarray(a[:,s:s+m]), Eb[:,:m], Vb[:,:,:m])
+        E[s:s+m] = Eb[:,:m].T
+        V[s:s+m] = Vb[:,:,:m].transpose(2,0,1)
+    return E.reshape(A.shape[:-1]), V.reshape(A.shape)
+
+
+def Eigsh3Block(a,E,V):
+
+    # a as (9,N) rows of A, E and V filled as (3,N) and (3,3,N)
+    a00, a01, a02, a10, a11, a12, a20, a21, a22 = a
+    # eigenvalues from the trigonometric solution of the characteristic cubic
+    q = (a00+a11+a22)/3.0
+    b00 = a00-q
+    b11 = a11-q
+    b22 = a22-q
+    s01 = a01*a01
+    s02 = a02*a02
+    s12 = a12*a12
+    p = ((b00*b00+b11*b11+b22*b22+2.0*(s01+s02+s12))/6.0)**0.5
+    # triple eigenvalue: any orthonormal basis is an eigenbasis, set at the end
+    iso = p <= 1e-14*np.abs(q)
+    p[iso] = 1.0
+    det = b00*(b11*b22-s12)-a01*(a01*b22-a12*a02)+a02*(a01*a12-b11*a02)
+    r = np.clip(det/(2.0*p**3), -1.0, 1.0)
+    # the best separated eigenvalue is the largest for r >= 0 and the smallest otherwise:
+    # q+2p*cos(acos(r)/3) or q+2p*cos(acos(r)/3+2pi/3) = q-2p*cos(acos(-r)/3)
+    top = ~np.signbit(r)
+    li = q+2.0*p*np.copysign(np.cos(np.arccos(np.abs(r))/3.0), r)
+    # its eigenvector v: the largest cross product of two rows of A-li*I
+    m00 = a00-li
+    m11 = a11-li
+    m22 = a22-li
+    c01 = [a01*a12-a02*m11, a02*a01-m00*a12, m00*m11-s01]
+    c02 = [a01*m22-a02*a12, s02-m00*m22, m00*a12-a01*a02]
+    c12 = [m11*m22-s12, a12*a02-a01*m22, a01*a12-m11*a02]
+    n01 = c01[0]*c01[0]+c01[1]*c01[1]+c01[2]*c01[2]
+    n02 = c02[0]*c02[0]+c02[1]*c02[1]+c02[2]*c02[2]
+    n12 = c12[0]*c12[0]+c12[1]*c12[1]+c12[2]*c12[2]
+    k01 = (n01 >= n02) & (n01 >= n12)
+    k02 = (n02 >= n12) & ~k01
+    v = np.array(c12)
+    np.copyto(v, c02, where=k02)
+    np.copyto(v, c01, where=k01)
+    nv = v[0]*v[0]+v[1]*v[1]+v[2]*v[2]
+    nv[nv == 0.0] = 1.0
+    v /= nv**0.5
+    v[:,iso] = [[0.0],[0.0],[1.0]]
+    v0, v1, v2 = v
+    # orthonormal u, w spanning the plane normal to v, branch free (Duff et al. 2017); the 
+    # other two eigenpairs are the exact solution of the 2x2 problem in that plane
+    sg = np.copysign(1.0, v2)
+    g = -1.0/(sg+v2)
+    h = v0*v1*g
+    u0 = 1.0+sg*v0*v0*g
+    u1 = sg*h
+    u2 = -sg*v0
+    w0 = h
+    w1 = sg+v1*v1*g
+    w2 = -v1
+    Au0 = a00*u0+a01*u1+a02*u2
+    Au1 = a01*u0+a11*u1+a12*u2
+    Au2 = a02*u0+a12*u1+a22*u2
+    a = u0*Au0+u1*Au1+u2*Au2
+    b = w0*Au0+w1*Au1+w2*Au2
+    c = w0*(a00*w0+a01*w1+a02*w2)+w1*(a01*w0+a11*w1+a12*w2)+w2*(a02*w0+a12*w1+a22*w2)
+    th = 0.5*np.arctan2(2.0*b, a-c)
+    ct = np.cos(th)
+    st = np.sin(th)
+    e1 = [ct*u0+st*w0, ct*u1+st*w1, ct*u2+st*w2]
+    e2 = [ct*w0-st*u0, ct*w1-st*u1, ct*w2-st*u2]
+    r = (0.25*(a-c)**2+b*b)**0.5
+    m1 = 0.5*(a+c)+r
+    m2 = 0.5*(a+c)-r
+    # Rayleigh quotient of v, more accurate than the trigonometric root
+    lv = v0*(a00*v0+2.0*(a01*v1+a02*v2))+v1*(a11*v1+2.0*a12*v2)+a22*v2*v2
+    # ascending order, eigenvectors in the columns as numpy.linalg.eigh: (v, e2, e1), or 
+    # (e2, e1, v) when v belongs to the largest eigenvalue
+    E[0] = lv
+    E[1] = m2
+    E[2] = m1
+    np.copyto(E[0], m2, where=top)
+    np.copyto(E[1], m1, where=top)
+    np.copyto(E[2], lv, where=top)
+    V[:,0] = v
+    V[:,1] = e2
+    V[:,2] = e1
+    np.copyto(V[:,0], e2, where=top)
+    np.copyto(V[:,1], e1, where=top)
+    np.copyto(V[:,2], v, where=top)
+    if iso.any():
+        E[:,iso] = q[iso]
+        V[:,:,iso] = np.eye(3)[:,:,None]
+
+########################################################
+######################Function 9: ######################
+########################################################
+
+def CijtvelCov(c1d,cov,n,dens,denserr):
+
+    vel, pol, jac = CijtvelJac(c1d, n, dens)
+    velcov = jac @ np.asarray(cov, dtype=float) @ np.swapaxes(jac,-1,-2)
+    # density: dV/ddens = -V/(2*dens), independent of the Cij
+    dvd = -vel/(2.0*dens)
+    velcov = velcov+dvd[...,:,None]*dvd[...,None,:]*denserr**2
+    velerr = np.diagonal(velcov, axis1=-2, axis2=-1)**0.5
+    return vel, velerr, velcov
+
+########################################################
+######################Function 10: #####################
+########################################################
+
+def CijtvelGroup(c1d,n,dens,enhance=True,degtol=1.0e-8):
+
+    vel, pol, vg, c4r, n, Y = GradSolve(c1d, n, dens)
+    gv = linalg.norm(vg, axis=-1)
+    psi = np.degrees(np.arccos(np.clip(vel/gv, -1.0, 1.0)))
+    res = dict(vel=vel, pol=pol, vg=vg, gv=gv, psi=psi)
+    if not enhance:
+        return res
+    densb = np.asarray(dens, dtype=float)[...,None,None]
+    E = densb*vel**2
+    # dGamma_ik/dn_a = Ciakl*nl+Ckail*nl, so Q[s,a,t] = pol_s.dGamma_a.pol_t = Y[s,a,t]+Y[t,a,s]
+    Q = Y+np.swapaxes(Y, -3, -1)
+    dE = E[...,:,None]-E[...,None,:]
+    deg = np.abs(dE) < degtol*E[...,:,None]
+    inv = np.where(deg, 0.0, 1.0/np.where(deg, 1.0, dE))
+    # Hessian: 2*Ciakb*pi*pk + 2*sum_t Q[s,a,t]*Q[s,b,t]/(E_s-E_t)
+    pp = (pol[...,:,:,None]*pol[...,:,None,:]).reshape(pol.shape[:-1]+(9,))
+    Cp = np.swapaxes(c4r, -3, -2).reshape(c4r.shape[:-4]+(9,9))
+    H = 2.0*np.matmul(pp, Cp[...,None,:,:]).reshape(pol.shape+(3,))
+    H = H+2.0*np.matmul(Q*inv[...,:,None,:], np.swapaxes(Q, -1, -2))
+    # Gaussian curvature of E(s) = dens: K = -det([[H,g],[g,0]])/|g|^4 = g.adj(H).g/|g|^4, 
+    # g = dE/ds; for s = n/V: g = dE/dn/V = 2*dens*vg (degree 1), H(s) = H(n) (degree 0)
+    g = 2.0*densb[...,None]*vg
+    h00, h11, h22 = H[...,0,0], H[...,1,1], H[...,2,2]
+    h01, h02, h12 = H[...,0,1], H[...,0,2], H[...,1,2]
+    g0, g1, g2 = g[...,0], g[...,1], g[...,2]
+    gag = ((h11*h22-h12*h12)*g0*g0+(h00*h22-h02*h02)*g1*g1+(h00*h11-h01*h01)*g2*g2
+           +2.0*((h02*h12-h01*h22)*g0*g1+(h01*h12-h02*h11)*g0*g2+(h01*h02-h00*h12)*g1*g2))
+    K = gag/(g0*g0+g1*g1+g2*g2)**2
+    A = 1.0/(np.abs(K)*gv/vel**3)
+    res['A'] = np.where(np.any(deg & ~np.eye(3, dtype=bool), axis=-1), np.nan, A)
+    return res
+